@@ -0,0 +1,99 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+"""
+Synthetic sheets and sources for the benchmarks. Everything is generated from the
+row count, so the benchmark and the stub server build the same data on their own.
+
+The source holds the sheet's keys with a few differences, so a sync has every kind of work:
+	every 10th sheet row is missing from the source and gets deleted
+	every 5th sheet row has a new department and gets updated
+	1 new source row for every 20 sheet rows gets created
+"""
+
+import io
+import csv
+
+# lookup and output columns, in source column order
+MAPPED_COLUMNS = ['Key', 'Name', 'Department', 'Email']
+COLUMN_ID_BASE = 1000
+ROW_ID_BASE = 5000000
+
+def getKey(number):
+	return 'K{:07d}'.format(number)
+
+def getRecord(number, changed=False):
+	department = 'D{}'.format(number % 50 + (100 if changed else 0))
+	return [getKey(number), 'Person {}'.format(number), department, 'person{}@example.com'.format(number)]
+
+def makeColumns(width):
+	"""
+	Returns the sheet's columns, the mapped columns followed by width columns that aren't mapped
+	"""
+	titles = MAPPED_COLUMNS + ['Notes {}'.format(number) for number in range(width)]
+	return [{'id': COLUMN_ID_BASE + index, 'title': title, 'index': index, 'type': 'TEXT_NUMBER'} for index, title in enumerate(titles)]
+
+def makeSheet(sheetId, rows, width):
+	"""
+	Returns a sheet in the form the API returns it, with rows already in sync with the source except for the differences above
+	"""
+	columns = makeColumns(width)
+	sheetRows = []
+
+	for number in range(rows):
+		values = getRecord(number) + ['Note {} for row {}'.format(index, number) for index in range(width)]
+		cells = [{'columnId': column['id'], 'value': value, 'displayValue': value} for column, value in zip(columns, values)]
+		sheetRows.append({'id': ROW_ID_BASE + number, 'rowNumber': number + 1, 'modifiedAt': '2024-01-01T00:00:00Z', 'cells': cells})
+
+	return {'id': sheetId, 'name': 'Benchmark {} rows'.format(rows), 'version': 1, 'totalRowCount': rows, 'columns': columns, 'rows': sheetRows}
+
+def makeSourceRecords(rows):
+	records = []
+
+	for number in range(rows):
+		if number % 10 == 9:
+			continue
+		records.append(getRecord(number, changed=number % 5 == 0))
+
+	for number in range(rows, rows + rows // 20):
+		records.append(getRecord(number))
+
+	return records
+
+def toCSV(records):
+	data = io.StringIO()
+	writer = csv.writer(data)
+	writer.writerow(MAPPED_COLUMNS)
+	writer.writerows(records)
+	return data.getvalue().encode('utf-8')
+
+def toXLSX(records):
+	# pandas writes xlsx with openpyxl, which the app already needs to read it
+	import pandas as pd
+
+	data = io.BytesIO()
+	pd.DataFrame(records, columns=MAPPED_COLUMNS).to_excel(data, index=False)
+	return data.getvalue()
+
+def makeMapping(sheetId, sourceId):
+	return {
+		'sheetId': sheetId,
+		'sources': [{
+			'sourceId': sourceId,
+			'lookupMapping': {'sourceKey': 0, 'sheetColumn': 'Key'},
+			'outputMappings': [{'sourceKey': index, 'sheetColumn': title} for index, title in enumerate(MAPPED_COLUMNS)]
+		}]
+	}
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+"""
+Measures a sync of a generated sheet against a local stub of the Smartsheet API.
+
+	python benchmarks/run.py --rows 1000,10000,100000 --sources csv,sheet,xlsx --output results.json
+
+Every row count and source type is synced twice:
+	full -- no sync state and an empty attachment cache, so every row is reconciled
+	unchanged -- straight after, with nothing changed, so the run should be skipped
+
+Each result has the total time, the time spent in each phase, the requests sent to the
+stub API and the mapping summary. The full sync is run again under tracemalloc to record
+peak memory, unless --no-memory is given. The results are written as JSON so runs from
+different commits can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import requests
+
+import generate
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'dataTracker')
+
+SHEET_ID = 1000
+SOURCE_SHEET_ID = 2000
+SOURCE_ID = 'benchmark'
+
+# source config for each source type, sourceId and isStrict are added to each
+SOURCE_TYPES = {
+	'csv': {'connectorClassName': 'CSVCon', 'fileName': 'benchmark.csv', 'hasHeaders': True},
+	'sheet': {'connectorClassName': 'SheetCon', 'fileName': 'benchmark.csv', 'sheetId': SOURCE_SHEET_ID},
+	'xlsx': {'connectorClassName': 'SheetCon', 'fileName': 'benchmark.xlsx', 'sheetId': SOURCE_SHEET_ID}
+}
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmarks a Data Tracker sync against a local stub of the Smartsheet API.')
+	parser.add_argument('--rows', default='1000,10000', help='comma separated sheet sizes, defaults to 1000,10000')
+	parser.add_argument('--sources', default='csv,sheet,xlsx', help='comma separated source types from {}, defaults to all'.format(','.join(SOURCE_TYPES)))
+	parser.add_argument('--width', type=int, default=20, help='sheet columns that are not mapped, defaults to 20')
+	parser.add_argument('--page-size', type=int, default=5000, help='sheetPageSize for the app, defaults to 5000')
+	parser.add_argument('--requests-per-minute', type=int, default=1000000, help='requestsPerMinute for the app, high by default so the rate limit is not measured')
+	parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run of each full sync')
+	parser.add_argument('--output', help='file to write the JSON results to, defaults to stdout')
+	parser.add_argument('--keep', action='store_true', help='keep the working directory with the settings, data and log')
+	args = parser.parse_args()
+
+	workDir = tempfile.mkdtemp(prefix='dataTracker-benchmark-')
+	stub = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'stub.py')], stdout=subprocess.PIPE, cwd=BENCH_DIR)
+
+	try:
+		stubURL = 'http://127.0.0.1:{}'.format(int(stub.stdout.readline()))
+		app = loadApp(workDir, stubURL, args)
+
+		results = []
+		for rows in [int(rows) for rows in args.rows.split(',')]:
+			for sourceType in args.sources.split(','):
+				results.extend(runCase(app, stubURL, workDir, rows, sourceType, args))
+
+		report = {
+			'commit': getCommit(),
+			'python': platform.python_version(),
+			'settings': {'width': args.width, 'pageSize': args.page_size, 'requestsPerMinute': args.requests_per_minute},
+			'maxRSSBytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+			'results': results
+		}
+	finally:
+		stub.terminate()
+		stub.wait()
+		if args.keep:
+			print('Working directory: {}'.format(workDir), file=sys.stderr)
+		else:
+			shutil.rmtree(workDir, ignore_errors=True)
+
+	if args.output:
+		with open(args.output, 'w') as outputFile:
+			json.dump(report, outputFile, indent=2)
+	else:
+		print(json.dumps(report, indent=2))
+
+def loadApp(workDir, stubURL, args):
+	"""
+	Points the app at a settings directory in workDir and imports it.
+	Returns a dict of the app modules.
+	"""
+	settingsDir = os.path.join(workDir, 'settings')
+	os.makedirs(settingsDir)
+	os.makedirs(os.path.join(workDir, 'sampleData'))
+
+	appConfig = {
+		'apiURL': stubURL,
+		'accessToken': 'benchmark',
+		'logLevel': 'logging.WARNING',
+		'logFileName': os.path.join(workDir, 'benchmark.log'),
+		'logFileMaxBytes': 10485760,
+		'logFileBackupCount': 1,
+		'requestsPerMinute': args.requests_per_minute,
+		'rateLimitBurst': 100,
+		'syncStateFile': 'syncState.json',
+		'attachmentCacheDir': os.path.join(workDir, 'cache'),
+		'sheetPageSize': args.page_size
+	}
+	with open(os.path.join(settingsDir, 'app.json'), 'w') as appFile:
+		json.dump(appConfig, appFile)
+
+	# the connectors read app.json when they're imported, and CSVCon reads files from sampleData in the working directory
+	os.environ['DATATRACKER_SETTINGS'] = settingsDir
+	os.chdir(workDir)
+	sys.path.insert(0, APP_DIR)
+
+	import main as dataTracker
+	from utils import config, client, match, registry, syncstate
+
+	return {'main': dataTracker, 'config': config, 'client': client, 'match': match, 'registry': registry, 'syncstate': syncstate, 'settingsDir': settingsDir}
+
+def runCase(app, stubURL, workDir, rows, sourceType, args):
+	print('{} rows from a {} source'.format(rows, sourceType), file=sys.stderr)
+
+	setupCase(app, stubURL, workDir, rows, sourceType, args)
+	results = [measure(app, stubURL, rows, sourceType, 'full'), measure(app, stubURL, rows, sourceType, 'unchanged')]
+
+	if not args.no_memory:
+		setupCase(app, stubURL, workDir, rows, sourceType, args)
+		tracemalloc.start()
+		sync(app, sourceType)
+		results[0]['peakMemoryBytes'] = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+	return results
+
+def setupCase(app, stubURL, workDir, rows, sourceType, args):
+	fileName = SOURCE_TYPES[sourceType]['fileName']
+	response = requests.post(stubURL + '/_bench/setup', json={'sheetId': SHEET_ID, 'rows': rows, 'width': args.width, 'sourceSheetId': SOURCE_SHEET_ID, 'attachments': [fileName]})
+	response.raise_for_status()
+
+	if sourceType == 'csv':
+		with open(os.path.join(workDir, 'sampleData', fileName), 'wb') as sourceFile:
+			sourceFile.write(generate.toCSV(generate.makeSourceRecords(rows)))
+
+	# every case starts with a full sync
+	if os.path.exists(os.path.join(app['settingsDir'], 'syncState.json')):
+		os.remove(os.path.join(app['settingsDir'], 'syncState.json'))
+	shutil.rmtree(os.path.join(workDir, 'cache'), ignore_errors=True)
+
+def measure(app, stubURL, rows, sourceType, scenario):
+	before = requests.get(stubURL + '/_bench/requests').json()
+
+	start = time.perf_counter()
+	summary = sync(app, sourceType)
+	seconds = time.perf_counter() - start
+
+	after = requests.get(stubURL + '/_bench/requests').json()
+	requestCounts = {}
+	for endpoint, count in after.items():
+		if count > before.get(endpoint, 0):
+			requestCounts[endpoint] = count - before.get(endpoint, 0)
+
+	print('  {}: {:.3f}s, {} requests, {}'.format(scenario, seconds, sum(requestCounts.values()), summary['status']), file=sys.stderr)
+
+	return {
+		'rows': rows,
+		'source': sourceType,
+		'scenario': scenario,
+		'seconds': round(seconds, 4),
+		'phases': dict((phase, round(phaseSeconds, 4)) for phase, phaseSeconds in summary['phases'].items()),
+		'requestCount': sum(requestCounts.values()),
+		'requests': requestCounts,
+		'summary': dict((key, summary.get(key)) for key in ('status', 'lookups', 'updated', 'deleted', 'created', 'failedRows'))
+	}
+
+def sync(app, sourceType):
+	"""
+	Runs the benchmark mapping once, the way main() does for a single run. Returns the mapping's summary.
+	"""
+	theConfig = app['config'].Config()
+	appConfig = theConfig.getConfigFromFile('app.json')
+	logger = theConfig.getLogger(appConfig)
+	headers = {'Authorization': 'Bearer ' + appConfig['accessToken']}
+	apiClient = app['client'].getClient(appConfig)
+	syncState = app['syncstate'].SyncState(os.path.join(app['settingsDir'], appConfig['syncStateFile']), logger)
+
+	sourceConfig = dict(SOURCE_TYPES[sourceType], sourceId=SOURCE_ID, isStrict=False)
+	mappings = [generate.makeMapping(SHEET_ID, SOURCE_ID)]
+	sourceRegistry = app['registry'].SourceRegistry([sourceConfig], mappings, logger)
+
+	return app['main'].runMappings(mappings, sourceRegistry, appConfig, apiClient, headers, app['match'].Match(), logger, syncState)[0]
+
+def getCommit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+if __name__ == '__main__':
+	main()
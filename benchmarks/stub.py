@@ -0,0 +1,191 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+"""
+Local stand in for the parts of the Smartsheet API the Data Tracker uses. It runs in
+its own process so its memory and CPU don't count against the app being measured.
+
+	python stub.py
+
+prints the port it listens on. Besides the API it has a few endpoints for the benchmark:
+	POST /_bench/setup -- {"sheetId", "rows", "width", "sourceSheetId", "attachments"} loads a generated sheet
+	    and a source sheet with the source attached as each of the named files
+	GET /_bench/requests -- request counts since the last setup, keyed on method and path
+"""
+
+import re
+import sys
+import json
+import threading
+import itertools
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import generate
+
+sheets = {}
+attachments = {}
+files = {}
+requestCounts = {}
+lock = threading.Lock()
+rowIds = itertools.count(9000000)
+modifiedTimes = itertools.count(1)
+
+class StubHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# headers and body go out in separate writes, without this every keep-alive response waits on a delayed ack
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		self.handle_request('GET')
+
+	def do_PUT(self):
+		self.handle_request('PUT')
+
+	def do_POST(self):
+		self.handle_request('POST')
+
+	def do_DELETE(self):
+		self.handle_request('DELETE')
+
+	def handle_request(self, method):
+		url = urlsplit(self.path)
+		params = parse_qs(url.query)
+		length = int(self.headers.get('Content-Length') or 0)
+		body = json.loads(self.rfile.read(length)) if length else None
+
+		if url.path.startswith('/_bench/'):
+			return self.handle_bench(method, url.path, body)
+
+		endpoint = '{} {}'.format(method, re.sub(r'/\d+', '/{id}', url.path))
+		with lock:
+			requestCounts[endpoint] = requestCounts.get(endpoint, 0) + 1
+
+		match = re.match(r'^/files/(\d+)$', url.path)
+		if match:
+			return self.send(200, files[int(match.group(1))], 'application/octet-stream')
+
+		match = re.match(r'^/sheets/(\d+)(/[a-z]+)?(/\d+)?$', url.path)
+		if not match or int(match.group(1)) not in sheets:
+			return self.sendJSON(404, {'errorCode': 1006, 'message': 'Not Found'})
+
+		sheet = sheets[int(match.group(1))]
+		resource = match.group(2)
+
+		if method == 'GET' and resource is None:
+			self.sendJSON(200, getPage(sheet, params))
+		elif method == 'GET' and resource == '/columns':
+			self.sendJSON(200, {'data': sheet['columns'], 'totalCount': len(sheet['columns'])})
+		elif method == 'GET' and resource == '/version':
+			self.sendJSON(200, {'version': sheet['version']})
+		elif method == 'GET' and resource == '/attachments' and match.group(3) is None:
+			self.sendJSON(200, {'data': attachments.get(sheet['id'], [])})
+		elif method == 'GET' and resource == '/attachments':
+			self.sendJSON(200, {'id': int(match.group(3)[1:]), 'url': 'http://{}:{}/files{}'.format(self.server.server_address[0], self.server.server_address[1], match.group(3))})
+		elif resource == '/rows' and method in ('PUT', 'POST', 'DELETE'):
+			with lock:
+				result = writeRows(sheet, method, body, params)
+			self.sendJSON(200, {'message': 'SUCCESS', 'resultCode': 0, 'version': sheet['version'], 'result': result})
+		else:
+			self.sendJSON(404, {'errorCode': 1006, 'message': 'Not Found'})
+
+	def handle_bench(self, method, path, body):
+		if method == 'POST' and path == '/_bench/setup':
+			with lock:
+				setup(body)
+			self.sendJSON(200, {'sheetId': body['sheetId']})
+		elif method == 'GET' and path == '/_bench/requests':
+			self.sendJSON(200, requestCounts)
+		else:
+			self.sendJSON(404, {})
+
+	def sendJSON(self, status, data):
+		self.send(status, json.dumps(data).encode('utf-8'), 'application/json')
+
+	def send(self, status, data, contentType):
+		self.send_response(status)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+def setup(config):
+	requestCounts.clear()
+	sheets[config['sheetId']] = generate.makeSheet(config['sheetId'], config['rows'], config['width'])
+
+	sourceSheetId = config.get('sourceSheetId')
+	if sourceSheetId:
+		sheets[sourceSheetId] = generate.makeSheet(sourceSheetId, 0, 0)
+		records = generate.makeSourceRecords(config['rows'])
+		attachments[sourceSheetId] = []
+		for index, fileName in enumerate(config.get('attachments', [])):
+			attachmentId = sourceSheetId * 10 + index
+			files[attachmentId] = generate.toXLSX(records) if fileName.endswith('.xlsx') else generate.toCSV(records)
+			attachments[sourceSheetId].append({'id': attachmentId, 'name': fileName, 'attachmentType': 'FILE', 'createdAt': '2024-01-01T00:00:00Z', 'sizeInKb': len(files[attachmentId]) // 1024})
+
+def getPage(sheet, params):
+	pageSize = int(params.get('pageSize', [len(sheet['rows']) or 1])[0])
+	page = int(params.get('page', ['1'])[0])
+	columnIds = None
+	if 'columnIds' in params:
+		columnIds = set(int(columnId) for columnId in params['columnIds'][0].split(','))
+
+	rows = []
+	for row in sheet['rows'][(page - 1) * pageSize:page * pageSize]:
+		if columnIds is not None:
+			row = dict(row, cells=[cell for cell in row['cells'] if cell['columnId'] in columnIds])
+		rows.append(row)
+
+	columns = sheet['columns'] if columnIds is None else [column for column in sheet['columns'] if column['id'] in columnIds]
+	return {'id': sheet['id'], 'name': sheet['name'], 'version': sheet['version'], 'totalRowCount': len(sheet['rows']), 'columns': columns, 'rows': rows}
+
+def writeRows(sheet, method, body, params):
+	modifiedAt = '2024-06-01T00:00:00.{:06d}Z'.format(next(modifiedTimes))
+	sheet['version'] += 1
+
+	if method == 'DELETE':
+		deleteIds = set(int(rowId) for rowId in params['ids'][0].split(','))
+		sheet['rows'] = [row for row in sheet['rows'] if row['id'] not in deleteIds]
+		return list(deleteIds)
+
+	if method == 'POST':
+		for row in body:
+			cells = [{'columnId': cell['columnId'], 'value': cell['value'], 'displayValue': str(cell['value'])} for cell in row['cells']]
+			sheet['rows'].append({'id': next(rowIds), 'modifiedAt': modifiedAt, 'cells': cells})
+		return body
+
+	rowsById = dict((row['id'], row) for row in sheet['rows'])
+	for update in body:
+		row = rowsById.get(update['id'])
+		if row is None:
+			continue
+		cells = dict((cell['columnId'], cell) for cell in row['cells'])
+		for cell in update['cells']:
+			cells[cell['columnId']] = {'columnId': cell['columnId'], 'value': cell['value'], 'displayValue': str(cell['value'])}
+		row['cells'] = list(cells.values())
+		row['modifiedAt'] = modifiedAt
+	return body
+
+def main():
+	server = ThreadingHTTPServer(('127.0.0.1', int(sys.argv[1]) if len(sys.argv) > 1 else 0), StubHandler)
+	print(server.server_address[1], flush=True)
+	server.serve_forever()
+
+if __name__ == '__main__':
+	main()
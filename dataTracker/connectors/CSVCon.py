@@ -34,6 +34,8 @@ class CSVCon:
 
 	def __init__(self, sourceConfig):
 		self.csvData = []
+		# lookup indexes keyed on the lookupKey column, built on first query of that column
+		self.indexes = {}
 
 		"""
 		 Example CSV Configuration ( to be set in the settings/sources.json file )
@@ -49,9 +51,13 @@ class CSVCon:
 		requiredFields = "fileName"
 		csvSourceConfig = theConfig.validateSourceConfig(sourceConfig, logger, requiredFields)
 
+		self.filePath = os.getcwd() + '/sampleData/' + csvSourceConfig['fileName']
+		self.hasHeaders = csvSourceConfig.get('hasHeaders', False)
+		self.fingerprint = self.getFingerprint()
+
 		# open CSV File
 		try:
-			with open(os.getcwd() + '/sampleData/' + csvSourceConfig['fileName']) as sourceFile:
+			with open(self.filePath) as sourceFile:
 				self.loadData(sourceFile)
 		except:
 			logger.error("Unable to open CSV file: {}".format(csvSourceConfig['fileName']))
@@ -64,15 +70,75 @@ class CSVCon:
 		for row in reader:
 			self.csvData.append(row)
 
+	def getFingerprint(self):
+		# modified time and size of the CSV file, None if it can't be read
+		try:
+			fileStat = os.stat(self.filePath)
+		except OSError:
+			return None
+		return "{}:{}".format(fileStat.st_mtime_ns, fileStat.st_size)
+
+	def refresh(self):
+		"""
+		 Reloads the CSV file if it changed since it was loaded, and drops the old indexes
+		"""
+		fingerprint = self.getFingerprint()
+		if fingerprint is None or fingerprint == self.fingerprint:
+			return
+
+		try:
+			with open(self.filePath) as sourceFile:
+				csvData = [row for row in csv.reader(sourceFile)]
+		except:
+			logger.error("Unable to open CSV file: {}".format(self.filePath))
+			return
+
+		logger.info("Reloaded changed CSV file: {}".format(self.filePath))
+		# swap everything at once so lookups running on other threads never see a half loaded file
+		self.csvData, self.indexes, self.fingerprint = csvData, {}, fingerprint
 
 	def findSourceMatch(self, lookupVal, lookupKey):
-		matchingRow = []
+		# query csv file index
+		return self.getIndex(lookupKey).get(lookupVal, [])
+
+	def findSourceMatches(self, lookupVals, lookupKey):
+		"""
+		 Resolves a set of lookup values against the column index.
+		 Returns a dict of lookup value to matching row, values without a match are left out.
+		"""
+		index = self.getIndex(lookupKey)
+
+		return {lookupVal: index[lookupVal] for lookupVal in lookupVals if lookupVal in index}
+
+	def getIndex(self, lookupKey):
+		"""
+		 Returns a dict of stripped lookupKey column values to CSV rows.
+		 The index is built the first time a column is queried and reused for every later lookup.
+		 When a key appears on more than one row, the first row in the file wins.
+		"""
+		# a refresh may swap the data while the index is built, so keep it with the data it came from
+		csvData, indexes = self.csvData, self.indexes
+		index = indexes.get(lookupKey)
+
+		if index is None:
+			index = {}
+			for sourceRow in csvData:
+				if len(sourceRow) > lookupKey:
+					index.setdefault(sourceRow[lookupKey].strip(), sourceRow)
+			indexes[lookupKey] = index
+
+		return index
+
+	def findTargetMissing(self, sheetData, lookupMapping):
+		"""
+		 Returns the CSV rows whose lookup value isn't in the sheet's lookup column.
+		 The header row is left out when hasHeaders is set, as are rows without a lookup value.
+		"""
+		csvData = self.csvData
+		lookupKey = lookupMapping['sourceKey']
+		sheetKeys = set(str(value).strip() for value in sheetData.getColumn(lookupMapping['sheetColumnId']) if value is not None)
 
-		# query csv file
-		for sourceRow in self.csvData:
-			if len(sourceRow):
-				if sourceRow[lookupKey].strip() == lookupVal:
-					matchingRow = sourceRow
-					break
+		if self.hasHeaders:
+			csvData = csvData[1:]
 
-		return matchingRow
+		return [sourceRow for sourceRow in csvData if len(sourceRow) > lookupKey and sourceRow[lookupKey].strip() != '' and sourceRow[lookupKey].strip() not in sheetKeys]
@@ -17,10 +17,20 @@
 """
 
 from utils import config
+from utils import lookup
+from utils.pool import ConnectionPool
 
-import MySQLdb
+import time
+import hashlib
 import logging
 
+try:
+	import MySQLdb
+	import MySQLdb.cursors
+except ImportError:
+	# only needed when MySQLCon makes its own connections, another DB-API connect function can be passed in
+	MySQLdb = None
+
 # debugging
 import pdb
 
@@ -36,7 +46,7 @@ logger = theConfig.getLogger(appConfig)
 
 class MySQLCon:
 
-	def __init__(self, sourceConfig):
+	def __init__(self, sourceConfig, connect=None, placeholder="%s"):
 
 		"""
 		 Example MySQL Configuration ( to be set in the settings/sources.json file )
@@ -48,32 +58,208 @@ class MySQLCon:
 			"dbPassword": "root",
 			"dbName": "dvDB",
 			"lookupQuery": "SELECT sku,name,description,price,quantity FROM product WHERE sku = %s",
+			"bulkLookupQuery": "SELECT sku,name,description,price,quantity FROM product WHERE sku IN ({})",
+			"bulkChunkSize": 1000,
+			"preload": false,
+			"preloadQuery": "SELECT sku,name,description,price,quantity FROM product",
+			"preloadBatchSize": 10000,
+			"preloadTTL": 300,
+			"poolSize": 1,
 			"isStrict": false
 		 }
+		 bulkLookupQuery and bulkChunkSize are optional, the {} in bulkLookupQuery is replaced with one %s per lookup value
+		 with preload the whole preloadQuery result is read once into memory and indexed, and read again after preloadTTL seconds in daemon mode
+		 poolSize is the number of connections kept open, defaults to the source's concurrency
+
+		 connect and placeholder swap in another DB-API driver, e.g. sqlite3.connect with "?", for trying queries without a MySQL server
 		
 		 list required fields other than 'sourceId' and 'connectorClassName' from sourceConfig entry
 		 'sourceId' and 'connectorClassName' are required for every source, and are already being checked
 		"""
 		requiredFields = "dbServer,dbUser,dbPassword,dbName,lookupQuery"
+		if sourceConfig.get('preload', False):
+			requiredFields += ",preloadQuery"
 		self.mySqlConfig = theConfig.validateSourceConfig(sourceConfig, logger, requiredFields)
+		self.placeholder = placeholder
+		# preloaded records, None when lookups go to the database
+		self.records = None
+		# preload indexes keyed on the lookupKey column, built on first query of that column
+		self.indexes = {}
+		self.fingerprint = None
+		self.loadedAt = None
+
+		if connect is None:
+			if MySQLdb is None:
+				logger.error("The MySQLdb module is needed for source {}, install mysqlclient".format(self.mySqlConfig['sourceId']))
+				theConfig.endBadly()
+			connect = self.connect
+			# server side cursors stream the preload instead of buffering the whole result set in the client
+			self.streamCursor = MySQLdb.cursors.SSCursor
+		else:
+			self.streamCursor = None
+
+		self.pool = ConnectionPool(connect, self.mySqlConfig.get('poolSize', self.mySqlConfig.get('concurrency', 1)))
 
 		# open db connection
 		try:
-			self.con = MySQLdb.connect(self.mySqlConfig['dbServer'], self.mySqlConfig['dbUser'], self.mySqlConfig['dbPassword'], self.mySqlConfig['dbName'])
-		except MySQLdb.Error as e:
-			logger.error("Error connecting to MySQL database: {}: {}".format(e.args[0],e.args[1]))
+			with self.pool.connection() as con:
+				self.dbError = getattr(con, 'Error', Exception)
+		except Exception as e:
+			logger.error("Error connecting to MySQL database: {}".format(self.formatError(e)))
 			theConfig.endBadly()
+
+		if self.mySqlConfig.get('preload', False):
+			self.loadRecords()
 		return None
 
+	def connect(self):
+		# autocommit so a pooled connection isn't held in a transaction that only sees old data
+		return MySQLdb.connect(self.mySqlConfig['dbServer'], self.mySqlConfig['dbUser'], self.mySqlConfig['dbPassword'], self.mySqlConfig['dbName'], autocommit=True)
+
+	def formatError(self, error):
+		return ": ".join(str(arg) for arg in error.args)
+
+	def loadRecords(self):
+		"""
+		 Reads the whole preloadQuery result, preloadBatchSize records at a time, and replaces the preloaded records.
+		 If the query fails the records loaded before are kept, or lookups go to the database when there are none.
+		"""
+		records = []
+		fingerprint = hashlib.sha1()
+		batchSize = self.mySqlConfig.get('preloadBatchSize', 10000)
+
+		try:
+			with self.pool.connection() as con:
+				cur = con.cursor(self.streamCursor) if self.streamCursor is not None else con.cursor()
+				try:
+					cur.execute(self.mySqlConfig['preloadQuery'])
+					while True:
+						batch = cur.fetchmany(batchSize)
+						if not len(batch):
+							break
+						records.extend(batch)
+						fingerprint.update(repr(batch).encode('utf-8'))
+				finally:
+					cur.close()
+		except self.dbError as e:
+			logger.error("Unable to preload source %s, DB Error %s", self.mySqlConfig['sourceId'], self.formatError(e))
+			return
+
+		logger.info("Preloaded {} records for source {}".format(len(records), self.mySqlConfig['sourceId']))
+		# swap everything at once so lookups running on other threads never see half a load
+		self.records, self.indexes, self.fingerprint, self.loadedAt = records, {}, fingerprint.hexdigest(), time.monotonic()
+
+	def refresh(self):
+		"""
+		 Reads the preloaded records again once they are older than preloadTTL seconds
+		"""
+		if self.mySqlConfig.get('preload', False) and (self.loadedAt is None or time.monotonic() - self.loadedAt >= self.mySqlConfig.get('preloadTTL', 300)):
+			self.loadRecords()
+
+	def getFingerprint(self):
+		"""
+		 Hash of the preloaded records, None when lookups go to the database as changes can't be seen then
+		"""
+		return self.fingerprint
+
+	def getIndex(self, lookupKey):
+		"""
+		 Returns a dict of lookupKey column values, as stripped strings, to preloaded records.
+		 When a key appears on more than one record, the first record wins as with fetchone in findSourceMatch.
+		"""
+		# a refresh may swap the records while the index is built, so keep it with the records it came from
+		records, indexes = self.records, self.indexes
+		index = indexes.get(lookupKey)
+
+		if index is None:
+			index = {}
+			for record in records:
+				if len(record) > lookupKey:
+					index.setdefault(str(record[lookupKey]).strip(), record)
+			indexes[lookupKey] = index
+
+		return index
+
 	def findSourceMatch(self, lookupVal, lookupKey):
-		matchingRecord = {}
+		if self.records is not None:
+			return self.getIndex(lookupKey).get(str(lookupVal).strip())
 
 		# query db
 		try:
-			cur = self.con.cursor()
-			cur.execute(self.mySqlConfig['lookupQuery'], lookupVal)
-			matchingRecord = cur.fetchone()
-		except MySQLdb.Error as e:
-			logger.error("DB Error {}: {}".format(e.args[0],e.args[1]))
-		
-		return matchingRecord
\ No newline at end of file
+			with self.pool.connection() as con:
+				cur = con.cursor()
+				try:
+					cur.execute(self.mySqlConfig['lookupQuery'], (lookupVal,))
+					return cur.fetchone()
+				finally:
+					cur.close()
+		except self.dbError as e:
+			logger.error("DB Error %s", self.formatError(e))
+			return lookup.FAILED
+
+	def findSourceMatches(self, lookupVals, lookupKey):
+		"""
+		 Resolves a set of lookup values from the preloaded records, or with the bulkLookupQuery one query per chunk of values.
+		 Records are matched back to lookup values on their lookupKey column. Values without a match are
+		 looked up individually with findSourceMatch, as the db may compare them differently, e.g. with a
+		 collation that ignores case or trailing spaces.
+		 Returns a dict of lookup value to matching record, values without a match are left out
+		 and values whose query failed are mapped to lookup.FAILED.
+		"""
+		matchingRecords = {}
+
+		if self.records is not None:
+			index = self.getIndex(lookupKey)
+			for lookupVal in lookupVals:
+				matchingRecord = index.get(str(lookupVal).strip())
+				if matchingRecord is not None:
+					matchingRecords[lookupVal] = matchingRecord
+			return matchingRecords
+
+		if 'bulkLookupQuery' not in self.mySqlConfig:
+			return self.findEach(lookupVals, lookupKey)
+
+		lookupVals = list(lookupVals)
+		# the db may return a different type than the sheet, so compare as strings
+		wantedVals = {str(lookupVal).strip(): lookupVal for lookupVal in lookupVals}
+		chunkSize = self.mySqlConfig.get('bulkChunkSize', 1000)
+
+		for start in range(0, len(lookupVals), chunkSize):
+			chunk = lookupVals[start:start + chunkSize]
+			query = self.mySqlConfig['bulkLookupQuery'].format(','.join([self.placeholder] * len(chunk)))
+
+			# query db
+			try:
+				with self.pool.connection() as con:
+					cur = con.cursor()
+					try:
+						cur.execute(query, chunk)
+						for record in cur.fetchall():
+							lookupVal = wantedVals.get(str(record[lookupKey]).strip())
+							# first record wins, as with fetchone in findSourceMatch
+							if lookupVal is not None and lookupVal not in matchingRecords:
+								matchingRecords[lookupVal] = record
+					finally:
+						cur.close()
+			except self.dbError as e:
+				logger.error("DB Error %s", self.formatError(e))
+				# a failed chunk mustn't look like a chunk of values with no match
+				for lookupVal in chunk:
+					matchingRecords.setdefault(lookupVal, lookup.FAILED)
+
+		unmatchedVals = [lookupVal for lookupVal in lookupVals if lookupVal not in matchingRecords]
+		if len(unmatchedVals):
+			matchingRecords.update(self.findEach(unmatchedVals, lookupKey))
+
+		return matchingRecords
+
+	def findEach(self, lookupVals, lookupKey):
+		"""
+		 Looks up each value with findSourceMatch and returns the values with a match or a failed lookup
+		"""
+		# each lookup takes its own connection from the pool, so they can run side by side
+		if self.pool.size > 1:
+			found = lookup.findSourceMatchesAsync(self.findSourceMatch, lookupVals, lookupKey, self.pool.size, logger)
+		else:
+			found = {lookupVal: self.findSourceMatch(lookupVal, lookupKey) for lookupVal in lookupVals}
+		return {lookupVal: matchingRecord for lookupVal, matchingRecord in found.items() if matchingRecord}
@@ -17,8 +17,12 @@
 """
 
 from utils import config
+from utils import lookup
 
+import time
 import ldap
+import ldap.filter
+from ldap.controls import SimplePagedResultsControl
 import logging
 
 # debugging
@@ -51,13 +55,39 @@ class OpenLDAPCon:
 			"searchFilter": "cn=*{}*",
 			"retrieveAttributes": "givenName,sn,roomNumber,mail,telephoneNumber",
 			"ldapTimeout": 0,
+			"bulkChunkSize": 100,
+			"preload": false,
+			"preloadFilter": "(objectClass=*)",
+			"preloadPageSize": 500,
+			"preloadTTL": 86400,
+			"preloadRefreshInterval": 60,
+			"lookupAttributes": "cn,mail,uid",
 			"isStrict": false
 		 }
+		 bulkChunkSize is optional and sets how many lookup values are OR'd into one search
+		 with preload every entry in the orgUnit is read once with a paged search and lookups are answered from memory,
+		 entries modified since are read again every preloadRefreshInterval seconds and everything is read again after preloadTTL seconds
 		 list required fields other than 'sourceId' and 'connectorClassName' from sourceConfig entry
 		 'sourceId' and 'connectorClassName' are required for every source, and are already being checked
 		"""
 		requiredFields = "ldapServer,baseDN,orgUnit,adminUser,adminPass,searchFilter,retrieveAttributes,ldapTimeout"
 		self.ldapConfig = theConfig.validateSourceConfig(sourceConfig, logger, requiredFields)
+		self.base = self.ldapConfig["orgUnit"] + "," + self.ldapConfig["baseDN"]
+
+		self.retrieveAttributes = []
+		if len(self.ldapConfig["retrieveAttributes"]):
+			for attr in self.ldapConfig["retrieveAttributes"].split(","):
+				self.retrieveAttributes.append(str(attr).strip())
+		self.preloadAttributes = self.getPreloadAttributes()
+
+		# preloaded entries keyed on dn, None when lookups search the server
+		self.entries = None
+		# preload indexes keyed on the lookupKey attribute, built on first query of that attribute
+		self.indexes = {}
+		self.loadedAt = None
+		self.refreshedAt = None
+		# newest modifyTimestamp of the preloaded entries, entries changed since are read on refresh
+		self.modifiedAt = None
 
 		# bind to LDAP server
 		try:
@@ -66,29 +96,233 @@ class OpenLDAPCon:
 			logger.info("Connected to LDAP at {}".format(self.ldapConfig["ldapServer"]))
 		except ldap.LDAPError as error_message:
 			logger.error("Couldn't connect to LDAP because of the following reason: {}".format(error_message), exc_info=True)
+			return None
+
+		if self.ldapConfig.get("preload", False):
+			self.loadEntries()
 		return None
 
+	def getPreloadAttributes(self):
+		# an empty list reads every attribute, otherwise the lookup attributes and modifyTimestamp are added
+		if not len(self.retrieveAttributes):
+			return ["*", "modifyTimestamp"]
+
+		attributes = list(self.retrieveAttributes)
+		for attr in self.ldapConfig.get("lookupAttributes", "cn,mail,uid").split(",") + ["modifyTimestamp"]:
+			if attr.strip() not in attributes:
+				attributes.append(attr.strip())
+		return attributes
+
+	def searchPaged(self, searchFilter):
+		"""
+		 Returns the (dn, entry) results of searchFilter, read preloadPageSize entries at a time
+		 so the server's size limit doesn't cut the result short
+		"""
+		results = []
+		control = SimplePagedResultsControl(True, size=self.ldapConfig.get("preloadPageSize", 500), cookie="")
+		timeout = self.ldapConfig["ldapTimeout"] if self.ldapConfig["ldapTimeout"] > 0 else -1
+
+		while True:
+			msgid = self.l.search_ext(self.base, ldap.SCOPE_SUBTREE, searchFilter, self.preloadAttributes, serverctrls=[control])
+			rtype, rdata, rmsgid, serverctrls = self.l.result3(msgid, timeout=timeout)
+			# referrals come back without a dn
+			results.extend(result for result in rdata if result[0] is not None)
+
+			pageControls = [serverctrl for serverctrl in serverctrls if serverctrl.controlType == SimplePagedResultsControl.controlType]
+			if not len(pageControls) or not pageControls[0].cookie:
+				return results
+			control.cookie = pageControls[0].cookie
+
+	def loadEntries(self):
+		"""
+		 Reads every entry of the orgUnit matching preloadFilter and replaces the preloaded entries.
+		 If the search fails the entries loaded before are kept, or lookups search the server when there are none.
+		"""
+		try:
+			results = self.searchPaged(self.ldapConfig.get("preloadFilter", "(objectClass=*)"))
+		except ldap.LDAPError as error_message:
+			logger.error("Unable to preload LDAP source %s because of the following reason: %s", self.ldapConfig["sourceId"], error_message)
+			return
+
+		entries = {}
+		for dn,entry in results:
+			entries[dn] = entry
+
+		logger.info("Preloaded {} LDAP entries for source {}".format(len(entries), self.ldapConfig["sourceId"]))
+		# swap everything at once so lookups running on other threads never see half a load
+		self.entries, self.indexes, self.modifiedAt = entries, {}, getNewestTimestamp(entries.values())
+		self.loadedAt = self.refreshedAt = time.monotonic()
+
+	def refresh(self):
+		"""
+		 Reads everything again once the preloaded entries are older than preloadTTL seconds,
+		 otherwise every preloadRefreshInterval seconds reads the entries modified since the newest one loaded.
+		 Deleted entries are only dropped by the full read.
+		"""
+		if not self.ldapConfig.get("preload", False):
+			return
+
+		now = time.monotonic()
+		if self.entries is None or self.modifiedAt is None or now - self.loadedAt >= self.ldapConfig.get("preloadTTL", 86400):
+			self.loadEntries()
+			return
+		if now - self.refreshedAt < self.ldapConfig.get("preloadRefreshInterval", 60):
+			return
+
+		searchFilter = "(&{}(modifyTimestamp>={}))".format(self.ldapConfig.get("preloadFilter", "(objectClass=*)"), ldap.filter.escape_filter_chars(self.modifiedAt))
+		try:
+			results = self.searchPaged(searchFilter)
+		except ldap.LDAPError as error_message:
+			logger.error("Unable to refresh LDAP source %s because of the following reason: %s", self.ldapConfig["sourceId"], error_message)
+			return
+
+		self.refreshedAt = now
+		# the newest entries are read again every time, as the timestamp includes them
+		changed = [(dn, entry) for dn,entry in results if self.entries.get(dn) != entry]
+		if not len(changed):
+			return
+
+		logger.info("Refreshed {} changed LDAP entries for source {}".format(len(changed), self.ldapConfig["sourceId"]))
+		entries = dict(self.entries)
+		for dn,entry in changed:
+			entries[dn] = entry
+		self.entries, self.indexes, self.modifiedAt = entries, {}, max(self.modifiedAt, getNewestTimestamp(entry for dn,entry in changed) or self.modifiedAt)
+
+	def getFingerprint(self):
+		"""
+		 Number of preloaded entries and the newest modifyTimestamp, None when nothing is preloaded as changes can't be seen then.
+		 Lookups on an attribute that wasn't preloaded search the server too, callers check isPreloaded for their lookupKey.
+		 Deleted entries don't change it until the full read after preloadTTL drops them.
+		"""
+		if self.entries is None or self.modifiedAt is None:
+			return None
+		return "{}:{}".format(len(self.entries), self.modifiedAt)
+
+	def getIndex(self, lookupKey):
+		"""
+		 Returns a dict of lowercased lookupKey attribute values, or dns, to preloaded records.
+		 Every value of a multi valued attribute is indexed, and the first entry wins when entries share a value.
+		"""
+		# a refresh may swap the entries while the index is built, so keep it with the entries it came from
+		entries, indexes = self.entries, self.indexes
+		index = indexes.get(lookupKey)
+
+		if index is None:
+			index = {}
+			for dn,entry in entries.items():
+				values = [dn] if lookupKey == "dn" else entry.get(lookupKey, [])
+				for value in values:
+					if isinstance(value, bytes):
+						value = value.decode("utf-8", "replace")
+					index.setdefault(str(value).lower(), entry)
+			indexes[lookupKey] = index
+
+		return index
+
+	def isPreloaded(self, lookupKey):
+		# lookups on an attribute that wasn't preloaded still search the server
+		return self.entries is not None and (lookupKey == "dn" or "*" in self.preloadAttributes or lookupKey in self.preloadAttributes)
+
+	def getRecord(self, entry):
+		"""
+		 Returns the first value of each of the retrieveAttributes, the same record a search returns
+		"""
+		return {key: val[0] for key,val in entry.items() if key != "modifyTimestamp" and len(val) and (not len(self.retrieveAttributes) or key in self.retrieveAttributes)}
+
 	def findSourceMatch(self, lookupVal, lookupKey):
 		matchingRecord = {}
-		base = self.ldapConfig["orgUnit"] + "," + self.ldapConfig["baseDN"]
+
+		if self.isPreloaded(lookupKey):
+			entry = self.getIndex(lookupKey).get(str(lookupVal).lower())
+			return self.getRecord(entry) if entry is not None else matchingRecord
+
 		scope = ldap.SCOPE_SUBTREE
 		searchFilter = self.ldapConfig["searchFilter"].format(lookupVal)
-		retrieve_attributes = []
-		search_result_set = []
-		timeout = self.ldapConfig["ldapTimeout"]
-
-		if len(self.ldapConfig["retrieveAttributes"]):
-			for attr in self.ldapConfig["retrieveAttributes"].split(","):
-				retrieve_attributes.append(str(attr))
 
 		# query LDAP server
 		try:
-			search_results = self.l.search_s(base, scope, searchFilter, retrieve_attributes)
+			search_results = self.l.search_s(self.base, scope, searchFilter, self.retrieveAttributes)
 			
 			for dn,entry in search_results:
 				for key,val in entry.items():
 					matchingRecord[key] = val[0]	
 		except ldap.LDAPError as error_message:
-			logger.error("LDAP Query busted because of the following reason: {} ".format(error_message, exc_info=True))
+			logger.error("LDAP Query busted because of the following reason: %s ", error_message, exc_info=True)
+			# an error mustn't look like a value with no match
+			return lookup.FAILED
 		
-		return matchingRecord
\ No newline at end of file
+		return matchingRecord
+
+	def findSourceMatches(self, lookupVals, lookupKey):
+		"""
+		 Resolves a set of lookup values from the preloaded entries when they hold the lookupKey attribute,
+		 otherwise with one OR'd searchFilter search per chunk of values.
+		 Entries are matched back to a lookup value through their lookupKey attribute, or their dn.
+		 Values that can't be matched back this way, such as wildcard filters on another
+		 attribute, are searched individually with findSourceMatch.
+		 Returns a dict of lookup value to matching record, values without a match are left out
+		 and values whose search failed map to lookup.FAILED.
+		"""
+		matchingRecords = {}
+
+		if self.isPreloaded(lookupKey):
+			index = self.getIndex(lookupKey)
+			for lookupVal in lookupVals:
+				entry = index.get(str(lookupVal).lower())
+				if entry is not None:
+					matchingRecords[lookupVal] = self.getRecord(entry)
+			return matchingRecords
+
+		scope = ldap.SCOPE_SUBTREE
+		retrieve_attributes = list(self.retrieveAttributes)
+		# the lookupKey attribute is needed to match entries back to lookup values
+		if len(retrieve_attributes) and lookupKey != "dn" and lookupKey not in retrieve_attributes:
+			retrieve_attributes.append(str(lookupKey))
+
+		lookupVals = list(lookupVals)
+		wantedVals = {str(lookupVal).lower(): lookupVal for lookupVal in lookupVals}
+		chunkSize = self.ldapConfig.get("bulkChunkSize", 100)
+
+		for start in range(0, len(lookupVals), chunkSize):
+			filters = []
+			for lookupVal in lookupVals[start:start + chunkSize]:
+				searchFilter = self.ldapConfig["searchFilter"].format(ldap.filter.escape_filter_chars(str(lookupVal)))
+				if not searchFilter.startswith("("):
+					searchFilter = "(" + searchFilter + ")"
+				filters.append(searchFilter)
+
+			# query LDAP server
+			try:
+				search_results = self.l.search_s(self.base, scope, "(|" + "".join(filters) + ")", retrieve_attributes)
+
+				for dn,entry in search_results:
+					if lookupKey == "dn":
+						entryKey = dn
+					elif lookupKey in entry and len(entry[lookupKey]):
+						entryKey = entry[lookupKey][0]
+					else:
+						continue
+					if isinstance(entryKey, bytes):
+						entryKey = entryKey.decode("utf-8", "replace")
+
+					lookupVal = wantedVals.get(str(entryKey).lower())
+					if lookupVal is not None and lookupVal not in matchingRecords:
+						matchingRecords[lookupVal] = {key: val[0] for key,val in entry.items()}
+			except ldap.LDAPError as error_message:
+				logger.error("LDAP Query busted because of the following reason: %s ", error_message, exc_info=True)
+
+		for lookupVal in lookupVals:
+			if lookupVal not in matchingRecords:
+				matchingRecord = self.findSourceMatch(lookupVal, lookupKey)
+				if matchingRecord is lookup.FAILED or len(matchingRecord):
+					matchingRecords[lookupVal] = matchingRecord
+
+		return matchingRecords
+
+def getNewestTimestamp(entries):
+	# generalized time from one server sorts in time order as a string
+	timestamps = [entry["modifyTimestamp"][0] for entry in entries if len(entry.get("modifyTimestamp", []))]
+	if not len(timestamps):
+		return None
+	newest = max(timestamps)
+	return newest.decode("utf-8") if isinstance(newest, bytes) else newest
@@ -17,6 +17,8 @@
 """
 
 from utils import config
+from utils import client
+from utils import lookup
 
 import requests
 import logging
@@ -36,9 +38,11 @@ logger = theConfig.getLogger(appConfig)
 
 class RestGETCon:
 
-	def __init__(self, sourceConfig):
+	def __init__(self, sourceConfig, apiClient=None):
 		# authorize api connection
 		self.apiConfig = sourceConfig;
+		# requests share the pooled session unless another client is passed in
+		self.apiClient = apiClient if apiClient is not None else client.getClient(appConfig)
 
 		"""
 		 Example REST GET Configuration ( to be set in the settings/sources.json file )
@@ -62,8 +66,24 @@ class RestGETCon:
 		matchingRecord = {}
 
 		# query API
-		resp = requests.get(self.apiConfig['apiUrl'].format(lookupVal))
-		respJSON = resp.json()
+		try:
+			resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupVal))
+		except requests.exceptions.RequestException as error_message:
+			logger.error("Request for lookupMapping value '%s' failed: %s", lookupVal, error_message)
+			return lookup.FAILED
+
+		# a missing record is a 404, any other error mustn't look like a value with no match
+		if resp.status_code == 404:
+			return matchingRecord
+		if resp.status_code != 200:
+			logger.error("Request for lookupMapping value '%s' failed with status %s", lookupVal, resp.status_code)
+			return lookup.FAILED
+
+		try:
+			respJSON = resp.json()
+		except ValueError as error_message:
+			logger.error("ValueError for lookupMapping value '%s': %s", lookupVal, error_message)
+			return lookup.FAILED
 
 		#build matchingRecord array
 		if self.apiConfig['isArray']:
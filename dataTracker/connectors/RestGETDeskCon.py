@@ -16,6 +16,8 @@
  ----------------------------------------------------------------------
 """
 from utils import config
+from utils import client
+from utils import lookup
 
 import requests
 import logging
@@ -35,9 +37,11 @@ logger = theConfig.getLogger(appConfig)
 
 class RestGETDeskCon:
 
-	def __init__(self, sourceConfig):
+	def __init__(self, sourceConfig, apiClient=None):
 		# authorize api connection
 		self.apiConfig = sourceConfig;
+		# requests share the pooled session unless another client is passed in
+		self.apiClient = apiClient if apiClient is not None else client.getClient(appConfig)
 
 		"""
 		 Example REST GET Desk.com Configuration ( to be set in the settings/sources.json file )
@@ -64,16 +68,31 @@ class RestGETDeskCon:
 
 		# query API
 		try:
-			if self.apiConfig['username']:
-				headers = {'Accept':'application/json','Content-type':'application/json'}
-				params = None
-				resp = requests.get(self.apiConfig['apiUrl'].format(lookupVal), headers=headers, params=params, auth=(self.apiConfig['username'], self.apiConfig['password']))
-		except KeyError:
-			resp = requests.get(self.apiConfig['apiUrl'].format(lookupVal))
+			try:
+				if self.apiConfig['username']:
+					headers = {'Accept':'application/json','Content-type':'application/json'}
+					params = None
+					resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupVal), headers=headers, params=params, auth=(self.apiConfig['username'], self.apiConfig['password']))
+			except KeyError:
+				resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupVal))
+		except requests.exceptions.RequestException as error_message:
+			logger.error("Request for lookupMapping value '%s' failed: %s", lookupVal, error_message)
+			return lookup.FAILED
 		
 		#print resp
 		
-		respJSON = resp.json()
+		# a missing record is a 404, any other error mustn't look like a value with no match
+		if resp.status_code == 404:
+			return matchingRecord
+		if resp.status_code != 200:
+			logger.error("Request for lookupMapping value '%s' failed with status %s", lookupVal, resp.status_code)
+			return lookup.FAILED
+
+		try:
+			respJSON = resp.json()
+		except ValueError as error_message:
+			logger.error("ValueError for lookupMapping value '%s': %s", lookupVal, error_message)
+			return lookup.FAILED
 
 		#build matchingRecord array
 		if self.apiConfig['isArray']:
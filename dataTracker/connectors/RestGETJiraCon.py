@@ -17,10 +17,14 @@
 """
 
 from utils import config
+from utils import client
+from utils import lookup
 
 import requests
 import logging
 import re
+import time
+import threading
 
 # debugging
 import pdb
@@ -32,9 +36,21 @@ appConfig = theConfig.getConfigFromFile("app.json")
 logger = theConfig.getLogger(appConfig)
 
 class RestGETJiraCon:
-	def __init__(self, sourceConfig):
+	def __init__(self, sourceConfig, apiClient=None):
 		# authorize api connection
 		self.apiConfig = sourceConfig;
+		# requests share the pooled session unless another client is passed in
+		self.apiClient = apiClient if apiClient is not None else client.getClient(appConfig)
+		# the sourceKeys mappings read, set by the SourceRegistry, None reads every field
+		self.outputKeys = None
+		# the fields parameter and flattened key prefixes for the outputKeys, worked out on first use
+		self.fields = None
+		self.keyPrefixes = None
+		self.fieldIds = None
+		# preloaded records keyed on the upper case issue key, None until the preloadJql search has run
+		self.issues = None
+		self.loadedAt = None
+		self.lock = threading.Lock()
 
 		"""
 		 Example REST GET JIRA Search Configuration ( to be set in the settings/sources.json file )
@@ -45,9 +61,22 @@ class RestGETJiraCon:
 			"username": "yourName",
 			"password": "yourPassword",
 			"isArray": true,
-			"isStrict": false
+			"isStrict": false,
+			"searchUrl": "https://yourOrg.atlassian.net/rest/api/latest/search",
+			"bulkChunkSize": 50,
+			"concurrency": 8,
+			"preloadJql": "project = ABC",
+			"preloadPageSize": 100,
+			"preloadTTL": 300
 		 },
 
+		 searchUrl and bulkChunkSize are optional. With a searchUrl, lookups on the issue key are
+		 resolved in bulk with a "key in (...)" JQL search of up to bulkChunkSize keys per request.
+		 With a preloadJql as well, every issue it finds is read a page at a time on the first lookup on the
+		 issue key and kept for preloadTTL seconds, and only keys it didn't find are searched for.
+		 The optional concurrency sets how many single issue requests run at once for everything else.
+		 Every request asks only for the fields the outputMappings read, when they can be worked out.
+
 		 list required fields other than 'sourceId' and 'connectorClassName' from sourceConfig entry
 		 'sourceId' and 'connectorClassName' are required for every source, and are already being checked
 		"""
@@ -62,26 +91,43 @@ class RestGETJiraCon:
 
 		# query API
 		try:
-			params = None
-			args = len(tuple(re.finditer("{}", self.apiConfig['apiUrl'])))
-			if 'username' in self.apiConfig:
-				if args == 2:
-					resp = requests.get(self.apiConfig['apiUrl'].format(lookupKey,lookupVal), params=params, auth=(self.apiConfig['username'], self.apiConfig['password']))
-				else:
-					resp = requests.get(self.apiConfig['apiUrl'].format(lookupVal), params=params, auth=(self.apiConfig['username'], self.apiConfig['password']))
-			elif 'base64Basic' in self.apiConfig:
-				headers = {'Authorization': 'Basic '+ self.apiConfig['base64Basic']}
-				if args == 2:
-					resp = requests.get(self.apiConfig['apiUrl'].format(lookupKey,lookupVal), params=params, headers=headers)
+			try:
+				params = {'fields': self.getFields()} if self.getFields() is not None else None
+				args = len(tuple(re.finditer("{}", self.apiConfig['apiUrl'])))
+				if 'username' in self.apiConfig:
+					if args == 2:
+						resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupKey,lookupVal), params=params, auth=(self.apiConfig['username'], self.apiConfig['password']))
+					else:
+						resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupVal), params=params, auth=(self.apiConfig['username'], self.apiConfig['password']))
+				elif 'base64Basic' in self.apiConfig:
+					headers = {'Authorization': 'Basic '+ self.apiConfig['base64Basic']}
+					if args == 2:
+						resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupKey,lookupVal), params=params, headers=headers)
+					else:
+						resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupVal), params=params, headers=headers)
+				elif args == 2:
+					resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupKey,lookupVal), params=params)
 				else:
-					resp = requests.get(self.apiConfig['apiUrl'].format(lookupVal), params=params, headers=headers)
-		except KeyError:
-			resp = requests.get(self.apiConfig['apiUrl'].format(lookupVal))
+					resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupVal), params=params)
+			except KeyError:
+				resp = self.apiClient.get(self.apiConfig['apiUrl'].format(lookupVal))
+		except requests.exceptions.RequestException as error_message:
+			logger.error("Request for lookupMapping value '%s' failed: %s", lookupVal, error_message)
+			return lookup.FAILED
+
+		# a missing issue is a 404, any other error mustn't look like a value with no match
+		if resp.status_code == 404:
+			logger.info("No Match for : %s ", lookupVal)
+			return matchingRecord
+		if resp.status_code != 200:
+			logger.error("Request for lookupMapping value '%s' failed with status %s", lookupVal, resp.status_code)
+			return lookup.FAILED
 
 		try:
 			respJSON = resp.json()
 		except ValueError as error_message:
-			logger.error("ValueError for lookupMapping value '{}': {}".format(lookupVal, error_message))
+			logger.error("ValueError for lookupMapping value '%s': %s", lookupVal, error_message)
+			return lookup.FAILED
 		try:
 			if self.apiConfig['isArray']:
 				if len(respJSON['issues']) > 0:
@@ -90,22 +136,224 @@ class RestGETJiraCon:
 			else:
 				matchingRecord.update(self.parseJiraFields(respJSON['fields']))
 		except KeyError as error_message:
-			logger.error("No Match for : {} ".format(self.apiConfig['apiUrl'].format(lookupVal)))
+			logger.info("No Match for : %s ", lookupVal)
 
 		return matchingRecord
 
-	def parseJiraFields(self,response,key='',path='',flattened=None):
-		if flattened is None:
-			flattened = {}
-		if type(response) not in(dict, list):
-			flattened[(str(path) if path else "") + (key.capitalize()) if path and type(key) is not int else str(key)] = response
-		elif isinstance(response, list):
-			for i, item in enumerate(response):
-				if (path):
-					self.parseJiraFields(item, str(i), "".join(filter(None,[path,key.capitalize()])), flattened)
-				else:
-					self.parseJiraFields(item, str(i), "".join(filter(None,[path,key.lower()])), flattened)
+	def findSourceMatches(self, lookupVals, lookupKey):
+		"""
+		 Resolves a set of issue keys with "key in (...)" JQL searches against the searchUrl.
+		 Keys that don't come back from the search (moved issues, other lookup keys or no searchUrl)
+		 are looked up individually with findSourceMatch.
+		 Returns a dict of lookup value to matching record, values without a match are left out
+		 and values whose request failed map to lookup.FAILED.
+		"""
+		matchingRecords = {}
+		lookupVals = list(lookupVals)
+
+		if 'searchUrl' in self.apiConfig and 'preloadJql' in self.apiConfig and lookupKey == 'key':
+			issues = self.getPreloadedIssues()
+			if issues is not None:
+				for lookupVal in lookupVals:
+					matchingRecord = issues.get(str(lookupVal).strip().upper())
+					if matchingRecord is not None:
+						matchingRecords[lookupVal] = matchingRecord
+				# issues moved out of the preloadJql are still found by the searches below
+				lookupVals = [lookupVal for lookupVal in lookupVals if lookupVal not in matchingRecords]
+
+		if 'searchUrl' in self.apiConfig and lookupKey == 'key':
+			wantedVals = {str(lookupVal).strip().upper(): lookupVal for lookupVal in lookupVals}
+			chunkSize = self.apiConfig.get('bulkChunkSize', 50)
+
+			for start in range(0, len(lookupVals), chunkSize):
+				chunk = lookupVals[start:start + chunkSize]
+				# validateQuery=warn keeps unknown keys from failing the whole search
+				params = {'jql': 'key in ({})'.format(','.join('"{}"'.format(str(lookupVal).strip()) for lookupVal in chunk)), 'validateQuery': 'warn', 'maxResults': len(chunk), 'startAt': 0}
+				if self.getFields() is not None:
+					params['fields'] = self.getFields()
+
+				while True:
+					try:
+						resp = self.apiClient.get(self.apiConfig['searchUrl'], params=params, **self.getAuthArgs())
+						respJSON = resp.json()
+						issues = respJSON['issues']
+					except (requests.exceptions.RequestException, ValueError, KeyError) as error_message:
+						# the keys of the chunk are looked up individually below
+						logger.error("Bulk search failed for {} keys: {}".format(len(chunk), error_message))
+						break
+
+					for issue in issues:
+						lookupVal = wantedVals.get(str(issue['key']).upper())
+						if lookupVal is not None:
+							matchingRecord = {'key': issue['key']}
+							matchingRecord.update(self.parseJiraFields(issue['fields']))
+							matchingRecords[lookupVal] = matchingRecord
+
+					params['startAt'] += len(issues)
+					if len(issues) == 0 or params['startAt'] >= respJSON.get('total', 0):
+						break
+
+		remainingVals = [lookupVal for lookupVal in lookupVals if lookupVal not in matchingRecords]
+		if self.apiConfig.get('concurrency', 1) > 1:
+			found = lookup.findSourceMatchesAsync(self.findSourceMatch, remainingVals, lookupKey, self.apiConfig['concurrency'], logger)
 		else:
-			for new_key, value in response.items():
-				self.parseJiraFields(value, new_key, path + (key.capitalize()) if path and type(key) is not int else str(key), flattened)
+			found = {lookupVal: self.findSourceMatch(lookupVal, lookupKey) for lookupVal in remainingVals}
+
+		for lookupVal, matchingRecord in found.items():
+			# failed lookups stay marked as lookup.FAILED so their rows are left alone
+			if matchingRecord is lookup.FAILED or len(matchingRecord):
+				matchingRecords[lookupVal] = matchingRecord
+
+		return matchingRecords
+
+	def getPreloadedIssues(self):
+		"""
+		 Returns a dict of upper case issue key to record for every issue the preloadJql finds, reading
+		 them the first time they're needed. Returns None if the search failed, so lookups search instead.
+		"""
+		with self.lock:
+			if self.issues is None:
+				self.issues = self.loadIssues()
+				self.loadedAt = time.monotonic()
+			return self.issues
+
+	def loadIssues(self):
+		issues = {}
+		params = {'jql': self.apiConfig['preloadJql'], 'startAt': 0, 'maxResults': self.apiConfig.get('preloadPageSize', 100)}
+		if self.getFields() is not None:
+			params['fields'] = self.getFields()
+
+		while True:
+			try:
+				resp = self.apiClient.get(self.apiConfig['searchUrl'], params=params, **self.getAuthArgs())
+				resp.raise_for_status()
+				respJSON = resp.json()
+				page = respJSON['issues']
+			except (requests.exceptions.RequestException, ValueError, KeyError) as error_message:
+				logger.error("Preload search failed for source {} after {} issues: {}".format(self.apiConfig['sourceId'], len(issues), error_message))
+				return None
+
+			for issue in page:
+				matchingRecord = {'key': issue['key']}
+				matchingRecord.update(self.parseJiraFields(issue['fields']))
+				issues[str(issue['key']).upper()] = matchingRecord
+
+			# the server may return fewer issues than maxResults, so page on what came back
+			params['startAt'] += len(page)
+			if len(page) == 0 or params['startAt'] >= respJSON.get('total', 0):
+				break
+
+		logger.info("Preloaded {} issues for source {}".format(len(issues), self.apiConfig['sourceId']))
+		return issues
+
+	def refresh(self):
+		"""
+		 Drops the preloaded issues once they are older than preloadTTL seconds, they are read again on the next lookup
+		"""
+		with self.lock:
+			if self.issues is not None and time.monotonic() - self.loadedAt >= self.apiConfig.get('preloadTTL', 300):
+				self.issues = None
+
+	def setOutputKeys(self, outputKeys):
+		"""
+		 Called by the SourceRegistry with the sourceKeys the mappings read from this source.
+		 When they change, preloaded issues flattened for the old keys are dropped and read again.
+		"""
+		outputKeys = set(str(outputKey) for outputKey in outputKeys)
+		if outputKeys != self.outputKeys:
+			with self.lock:
+				self.outputKeys, self.fields, self.keyPrefixes = outputKeys, None, None
+				self.issues, self.loadedAt = None, None
+
+	def getFields(self):
+		"""
+		 Returns the fields parameter that asks Jira for only the fields holding the outputKeys,
+		 or None to read every field when the outputKeys or Jira's field ids aren't known.
+		 A flattened key starts with the id of the field it came from, lower cased for list fields,
+		 so every field id that starts a key is asked for.
+		"""
+		if self.outputKeys is None:
+			return None
+
+		if self.fields is None:
+			if self.fieldIds is None:
+				self.fieldIds = self.getFieldIds()
+
+			fields = set()
+			for outputKey in self.outputKeys:
+				for fieldId in self.fieldIds:
+					if outputKey.startswith(fieldId) or outputKey.startswith(fieldId.lower()):
+						fields.add(fieldId)
+			self.fields = ','.join(sorted(fields)) if len(fields) else ''
+
+		return self.fields if len(self.fields) else None
+
+	def getFieldIds(self):
+		"""
+		 Returns the ids of every Jira field from the field endpoint next to the apiUrl, an empty list if they can't be read
+		"""
+		apiBase = re.match(r'(.*/rest/api/[^/]+)/', self.apiConfig['apiUrl'])
+		if apiBase is None:
+			return []
+
+		try:
+			resp = self.apiClient.get(apiBase.group(1) + '/field', **self.getAuthArgs())
+			resp.raise_for_status()
+			return [field['id'] for field in resp.json()]
+		except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as error_message:
+			logger.warning("Unable to read the Jira fields for source {}, every field will be read: {}".format(self.apiConfig['sourceId'], error_message))
+			return []
+
+	def getAuthArgs(self):
+		if 'username' in self.apiConfig:
+			return {'auth': (self.apiConfig['username'], self.apiConfig['password'])}
+		elif 'base64Basic' in self.apiConfig:
+			return {'headers': {'Authorization': 'Basic '+ self.apiConfig['base64Basic']}}
+		return {}
+
+	def parseJiraFields(self, response):
+		"""
+		 Flattens the issue fields into one dict, joining the keys on the way down with each one capitalized,
+		 e.g. assignee.displayName becomes assigneeDisplayname. List items are keyed on their position,
+		 and a list field's own key is lower cased, e.g. the first of the fixVersions is fixversions0Name.
+
+		 When the outputKeys are known only those are extracted, and branches that can't lead to one of them,
+		 like the comments of an issue, are never walked.
+		"""
+		flattened = {}
+		keyPrefixes = self.getKeyPrefixes()
+		# walked with a stack rather than recursion, children are pushed in reverse so they come off in order
+		stack = [(response, '')]
+
+		while len(stack):
+			value, name = stack.pop()
+			if type(value) not in (dict, list):
+				if keyPrefixes is None or name in self.outputKeys:
+					flattened[name] = value
+				continue
+
+			items = enumerate(value) if isinstance(value, list) else value.items()
+			children = []
+			for key, item in items:
+				if name:
+					childName = name + str(key).capitalize()
+				elif isinstance(item, list):
+					childName = str(key).lower()
+				else:
+					childName = str(key)
+				if keyPrefixes is None or childName in keyPrefixes:
+					children.append((item, childName))
+			stack.extend(reversed(children))
+
 		return flattened
+
+	def getKeyPrefixes(self):
+		"""
+		 Returns every leading part of the outputKeys, a branch is only walked when its flattened name is one of them.
+		 None when the outputKeys aren't known and everything is flattened.
+		"""
+		if self.outputKeys is None:
+			return None
+		if self.keyPrefixes is None:
+			self.keyPrefixes = set(outputKey[:end] for outputKey in self.outputKeys for end in range(len(outputKey) + 1))
+		return self.keyPrefixes
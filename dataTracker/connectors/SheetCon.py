@@ -1,20 +1,33 @@
 from utils import config
+from utils import client
+from utils import cache
+from utils.metrics import runMetrics
 
 import os
 import csv
 from io import StringIO, BytesIO
 import urllib, requests
 import pandas as pd
+import numpy as np
 
 theConfig = config.Config()
 
 appConfig = theConfig.getConfigFromFile("app.json")
 logger = theConfig.getLogger(appConfig)
+apiClient = client.getClient(appConfig)
+# parsed attachments, so an unchanged attachment is only downloaded once
+attachmentCache = cache.AttachmentCache(os.path.join(theConfig.baseDir, appConfig.get("attachmentCacheDir", "cache")), appConfig.get("attachmentCacheMaxBytes", 524288000), logger)
 
 class SheetCon:
     def __init__(self, sourceConfig):
         self.config = sourceConfig
         self.data = pd.DataFrame()
+        # the rows of data as an array, for lookups by position
+        self.rows = self.data.to_numpy()
+        # row position indexes keyed on the lookupKey column, built on first query of that column
+        self.indexes = {}
+        # the attachment the data was loaded from
+        self.attachment = None
         """
 		 Example CSV Configuration ( to be set in the settings/sources.json file )
 		 {
@@ -33,8 +46,19 @@ class SheetCon:
         # self.findSourceMatch("C53562CAT1T", 24)
 
     def getAttachment(self):
+        attachment = self.findAttachment()
+
+        if attachment is not None:
+            self.loadAttachment(attachment)
+        else:
+            logger.info("No attachment found matching {}.".format(self.config["fileName"]))
+
+    def findAttachment(self):
+        """
+        Returns the newest file attachment named fileName, None if there isn't one.
+        """
         headers = {"Authorization": "Bearer {}".format(appConfig["accessToken"])}
-        attachments = requests.get("{}/sheets/{}/attachments".format(appConfig["apiURL"], self.config["sheetId"]), headers=headers).json()["data"]
+        attachments = apiClient.get("{}/sheets/{}/attachments".format(appConfig["apiURL"], self.config["sheetId"]), headers=headers).json()["data"]
         matches = []
         for attachment in attachments:
             if str(attachment["attachmentType"]).lower() == "file" and attachment["name"] == self.config["fileName"]:
@@ -42,62 +66,117 @@ class SheetCon:
         matches = sorted(matches, key=lambda x: x["createdAt"], reverse=True)
 
         if len(matches):
-            url = requests.get("{}/sheets/{}/attachments/{}".format(appConfig["apiURL"], self.config["sheetId"], matches[0]["id"]), headers=headers).json()["url"]
+            return matches[0]
+        return None
+
+    def loadAttachment(self, attachment):
+        self.attachment = attachment
+
+        data = attachmentCache.get(attachment)
+        if data is not None:
+            self._setData(data)
+            return
+
+        headers = {"Authorization": "Bearer {}".format(appConfig["accessToken"])}
+        url = apiClient.get("{}/sheets/{}/attachments/{}".format(appConfig["apiURL"], self.config["sheetId"], attachment["id"]), headers=headers).json()["url"]
 
-            content = requests.get(url)
+        content = apiClient.get(url)
 
+        with runMetrics.timer("attachment_parse_seconds", sourceId=self.config["sourceId"]):
             if str(attachment["name"]).endswith(".xlsx"):
                 self._loadXLSX(BytesIO(content.content))
             if str(attachment["name"]).endswith(".csv"):
                 self._loadCSV(BytesIO(content.content))
-        else:
-            logger.info("No attachment found matching {}.".format(self.config["fileName"]))
 
+        attachmentCache.put(attachment, self.data)
+
+    def refresh(self):
+        """
+        Loads the attachment again if a newer version has been uploaded since it was loaded.
+        """
+        attachment = self.findAttachment()
+        if attachment is None or (self.attachment is not None and attachment["id"] == self.attachment["id"] and attachment["createdAt"] == self.attachment["createdAt"]):
+            return
+
+        logger.info("Reloading attachment {} for source {}".format(attachment["name"], self.config["sourceId"]))
+        self.loadAttachment(attachment)
+
+    def getFingerprint(self):
+        """
+        Identifies the loaded attachment by its id and upload time, None when nothing was loaded.
+        """
+        if self.attachment is None:
+            return None
+        return "{}:{}".format(self.attachment["id"], self.attachment["createdAt"])
 
     def _loadXLSX(self, data):
-        self.data = pd.read_excel(data, index=False)
+        self._setData(pd.read_excel(data, keep_default_na=False))
 
     def _loadCSV(self, data):
-        self.data = pd.read_csv(data, keep_default_na=False)
+        self._setData(pd.read_csv(data, keep_default_na=False))
+
+    def _setData(self, data):
+        # swap everything at once so lookups running on other threads never mix rows and indexes of two loads
+        self.data, self.rows, self.indexes = data, data.to_numpy(), {}
 
     def findSourceMatch(self, lookupVal, lookupKey):
-        if len(self.data) == 0:
+        data, rows, indexes = self.data, self.rows, self.indexes
+        if len(data) == 0:
             return []
 
-        match = self.data[self.data.iloc[:, lookupKey] == lookupVal]
-        match = match.to_numpy()
-        if len(match) > 0:
-            return match[0]
-        return match
+        position = self.getIndex(lookupKey, data, indexes).get(lookupVal)
+        if position is None:
+            return []
+
+        return rows[position]
+
+    def findSourceMatches(self, lookupVals, lookupKey):
+        """
+        Resolves a set of lookup values in one pass over the column index.
+        Returns a dict of lookup value to matching row, values without a match are left out.
+        """
+        # a refresh may swap the data, so the rows and index of one load are used together
+        data, rows, indexes = self.data, self.rows, self.indexes
+        if len(data) == 0:
+            return {}
+
+        index = self.getIndex(lookupKey, data, indexes)
+
+        return {lookupVal: rows[index[lookupVal]] for lookupVal in lookupVals if lookupVal in index}
+
+    def getIndex(self, lookupKey, data, indexes):
+        """
+        Returns a dict of lookupKey column values to row positions in data, kept in indexes,
+        the indexes of that data. The index is built the first time a column is queried and
+        reused for every later lookup. When a value appears on more than one row, the first row wins.
+        """
+        index = indexes.get(lookupKey)
+
+        if index is None:
+            column = data.iloc[:, lookupKey]
+            positions = np.flatnonzero(~column.duplicated(keep="first").to_numpy())
+            index = dict(zip(column.to_numpy()[positions], positions))
+            indexes[lookupKey] = index
+
+        return index
 
     def findTargetMissing(self, sheetData, lookupMapping):
         """
+        Returns the source rows whose lookup value isn't in the sheet's lookup column.
             lookupMapping = {
                 "sourceKey": 0,
                 "sheetColumn: "Column Title",
                 "sheetColumnId": 0
             }
         """
-        sheetDF = []
-        for row in sheetData["rows"]:
-            for cell in row["cells"]:
-                if cell["columnId"] == lookupMapping["sheetColumnId"]:
-                    if "displayValue" in cell:
-                        sheetDF.append({lookupMapping["sheetColumn"]: cell["displayValue"]})
-                    elif "value" in cell:
-                        sheetDF.append({lookupMapping["sheetColumn"]: cell["value"]})
-
-        sheetDF = pd.DataFrame.from_records(sheetDF)
-
-        if len(self.data.to_numpy()) == 0:
-            self.data = pd.DataFrame(columns=[lookupMapping["sheetColumn"]])
+        if len(self.data) == 0:
+            return []
 
-        if len(sheetDF.to_numpy()) == 0:
-        	sheetDF = pd.DataFrame(columns=[lookupMapping["sheetColumn"]])
+        # values are compared as text, the sheet's display values are strings while pandas parses numbers
+        sheetKeys = set(str(value) for value in sheetData.getColumn(lookupMapping["sheetColumnId"]) if value is not None)
+        column = self.data.iloc[:, lookupMapping["sourceKey"]].astype(str)
 
-        non_matching = pd.merge(self.data, sheetDF, how='outer', indicator=True, on=lookupMapping["sheetColumn"])
-        non_matching = non_matching[(non_matching._merge == 'left_only')]
-        non_matching = non_matching.drop("_merge", axis=1)
-        non_matching = non_matching.to_numpy()
+        # rows without a lookup value could never be matched, so they aren't added either
+        missing = ~column.isin(sheetKeys) & (column.str.strip() != "")
 
-        return non_matching
+        return self.data[missing.to_numpy()].to_numpy()
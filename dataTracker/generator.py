@@ -1,6 +1,8 @@
 import os
 import re
 from utils import config
+from utils import client
+from utils.metrics import runMetrics
 import copy
 
 from smartsheet import Smartsheet
@@ -16,12 +18,14 @@ class Generator:
         self.mappings = []
         self.sources = []
 
-        cloudMappings = self.getCloudMappings()
+        with runMetrics.timer("generator_seconds", step="cloudMappings"):
+            cloudMappings = self.getCloudMappings()
 
         for mappingConfig in cloudMappings:
             sourceTemplate = mappingConfig["sources"]
             mapTemplate = mappingConfig["mapping"]
-            reportData = self.getReport(mappingConfig["reportId"], mappingConfig["mappingName"])
+            with runMetrics.timer("generator_seconds", step="report"):
+                reportData = self.getReport(mappingConfig["reportId"], mappingConfig["mappingName"])
 
             for sourceSheet in reportData.source_sheets:
                 # generate sources
@@ -60,6 +64,8 @@ class Generator:
 
                 self.mappings.append(newMapping)
 
+        runMetrics.increment("generated_sources", len(self.sources))
+        runMetrics.increment("generated_mappings", len(self.mappings))
         self.configLoader.validateMappingConfig(self.mappings, self.logger)
         # NOTE: validateSourceConfig is used to validate each source individually, there is no validate all sources right now
         # self.configLoader.validateSourceConfig(self.sources, self.logger, "fileName,hasHeaders")
@@ -89,7 +95,7 @@ class Generator:
 
         attachment = sorted(matches, key=lambda x: x.created_at, reverse=True)[0]
         url = self.client.Attachments.get_attachment(self.appConfig["secretsId"], attachment.id).url
-        return self.configLoader.getConfigFromURL(url)
+        return self.configLoader.getConfigFromURL(url, client.getClient(self.appConfig))
 
     def getReport(self, reportId, mappingName):
         """
@@ -27,9 +27,17 @@
 
 from utils import config
 from utils import match
+from utils import client
+from utils import metrics
+from utils.scheduler import Scheduler
+from utils.syncstate import SyncState
+from utils.cache import LookupCache
+from utils.registry import SourceRegistry
+from utils.sheet import SheetReader, SheetIndex
 from generator import Generator
 
 import requests
+import argparse
 import json
 import os
 import sys
@@ -37,29 +45,87 @@ import logging
 import datetime
 import time
 import string
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 # debugging
 import pdb
 
+# file names for the json config files in settings directory
+APP_CONFIG_FILE = 'app.json'
+SOURCES_FILE = 'sources.json'
+MAPPINGS_FILE = 'mapping.json'
+# failed rows logged for each write, the rest are only counted
+MAX_LOGGED_FAILED_ITEMS = 10
+
 def main():
-	theConfig = config.Config()
-	theMatch = match.Match()
-	# file names for the json config files in settings directory
-	APP_CONFIG_FILE = 'app.json'
-	SOURCES_FILE = 'sources.json'
-	MAPPINGS_FILE = 'mapping.json'
+	parser = argparse.ArgumentParser(description='Updates Smartsheet sheets with data from external sources.')
+	parser.add_argument('--daemon', action='store_true', help='keep running and update each mapping on its own interval')
+	args = parser.parse_args()
 
+	theConfig = config.Config()
 
 	# read app config
 	appConfig = theConfig.getConfigFromFile(APP_CONFIG_FILE)
 	logger = theConfig.getLogger(appConfig)
 
 	logger.info('***Smartsheet Data Tracker Utility Started: {}'.format(str(datetime.datetime.now()).split('.')[0]))
-	API_URL = appConfig['apiURL']
 	ACCESS_TOKEN = 'Bearer ' + appConfig['accessToken']
 	headers = {'Authorization': ACCESS_TOKEN}
+	apiClient = client.getClient(appConfig)
+
+	# remembers what each mapping last synced so unchanged sheets can be skipped
+	syncState = None
+	if appConfig.get('syncStateFile', 'syncState.json'):
+		syncState = SyncState(os.path.join(theConfig.baseDir, theConfig.configDir, appConfig.get('syncStateFile', 'syncState.json')), logger)
+
+	# remembers lookup results across mappings, for the sources that set a lookupCacheTTL
+	lookupCache = None
+	if appConfig.get('lookupCacheSize', 100000):
+		lookupCacheFile = None
+		if appConfig.get('lookupCacheFile'):
+			lookupCacheFile = os.path.join(theConfig.baseDir, theConfig.configDir, appConfig['lookupCacheFile'])
+		lookupCache = LookupCache(appConfig.get('lookupCacheSize', 100000), logger, lookupCacheFile)
+	theMatch = match.Match(lookupCache)
+
+	print
+	print(' Smartsheet Data Tracker')
+	print('============================')
+	if(appConfig['logFileName']):
+		print('Logging to file: {}'.format(appConfig['logFileName']))
 
-	generator = Generator()
+	if args.daemon or appConfig.get('daemon', False):
+		runDaemon(theConfig, appConfig, apiClient, headers, theMatch, logger, syncState)
+		return
+
+	sourceConfigs, mappings = loadConfigs(theConfig, logger)
+	if syncState is not None:
+		syncState.retain(mappings)
+
+	if len(mappings):
+		registry = SourceRegistry(sourceConfigs, mappings, logger)
+		summaries = runMappings(mappings, registry, appConfig, apiClient, headers, theMatch, logger, syncState)
+		failedMappings = len([summary for summary in summaries if summary['status'] == 'failed'])
+		print('{} of {} mappings completed'.format(len(summaries) - failedMappings, len(summaries)))
+
+		for endpoint, retries in apiClient.retries.items():
+			logger.info('Retried {} {} times'.format(endpoint, retries))
+		if lookupCache is not None:
+			saveLookupCache(lookupCache, logger)
+		writeRunReport(theConfig, appConfig, summaries, logger)
+		logger.info('===Smartsheet Data Tracker Utility Completed: {}'.format(str(datetime.datetime.now()).split('.')[0]))
+	else:
+		logger.error('There are no mappings configured. Please add a properly formatted mapping node to the mapping.json file.')
+
+def loadConfigs(theConfig, logger):
+	"""
+	Generates the cloud configs, then reads and validates sources.json and mapping.json.
+	Source objects are created later, by the SourceRegistry, when a mapping first uses them.
+	Returns a tuple of (sourceConfigs, mappings).
+	"""
+	with metrics.runMetrics.timer('config_load_seconds'):
+		generator = Generator()
 
 	"""
 	 read sources config
@@ -71,17 +137,10 @@ def main():
 	"""
 	sourceConfigs = theConfig.getConfigFromFile(SOURCES_FILE)
 
-	# loop source configs and initialize sourceConfig objects
+	# check source configs, the source objects are loaded when a mapping needs them
 	if len(sourceConfigs):
 		for sourceConf in sourceConfigs:
-			if sourceConf['cloud'] == True:
-				logger.info('Delegating source load for source {} until updating target sheet.'.format(sourceConf['sourceId']))
-				continue
-			try:
-				module = __import__('connectors.' + sourceConf['connectorClassName'], fromlist=[sourceConf['connectorClassName']])
-				sourceClass = getattr(module, sourceConf['connectorClassName'])
-				sourceConf['sourceObject'] = sourceClass(sourceConf)
-			except KeyError as error_message:
+			if 'connectorClassName' not in sourceConf:
 				logger.error('Source with id {} needs a connectorClassName attribute'.format(sourceConf['sourceId']))
 				theConfig.endBadly()
 	else:
@@ -101,187 +160,444 @@ def main():
 	# validate mapping configs
 	theConfig.validateMappingConfig(mappings, logger)
 
-	print
-	print(' Smartsheet Data Tracker')
-	print('============================')
-	if(appConfig['logFileName']):
-		print('Logging to file: {}'.format(appConfig['logFileName']))
-	if len(mappings):
+	return sourceConfigs, mappings
+
+def runMappings(mappings, registry, appConfig, apiClient, headers, theMatch, logger, syncState=None):
+	"""
+	Runs every mapping once and returns the list of mapping summaries
+	"""
+	# mappings for the same sheet run in order in one worker, different sheets run in parallel
+	sheetMappings = {}
+	for mapping in mappings:
+		sheetMappings.setdefault(mapping['sheetId'], []).append(mapping)
+
+	def processSheet(sheetMappingList):
+		return [runMapping(mapping, registry, appConfig, apiClient, headers, theMatch, logger, syncState) for mapping in sheetMappingList]
+
+	with ThreadPoolExecutor(max_workers=max(1, appConfig.get('mappingWorkers', 4))) as executor:
+		summaries = [summary for sheetSummaries in executor.map(processSheet, sheetMappings.values()) for summary in sheetSummaries]
+
+	for summary in summaries:
+		logSummary(summary, logger)
+
+	return summaries
+
+def runDaemon(theConfig, appConfig, apiClient, headers, theMatch, logger, syncState=None):
+	"""
+	Keeps running, updating each mapping every interval seconds (scheduleInterval in app.json,
+	or an interval on the mapping). Connectors and their caches stay loaded between runs.
+	The cloud configs are regenerated every configRefreshInterval seconds.
+	The run report is written after every run, with the metrics since the daemon started.
+	The lookup cache is saved each time the configs are regenerated.
+	"""
+	registry = None
+	# the last summary of each mapping, for the run report
+	summaries = {}
+	reportLock = threading.Lock()
+
+	def runScheduledMapping(mapping):
+		summary = runMapping(mapping, registry, appConfig, apiClient, headers, theMatch, logger, syncState)
+		logSummary(summary, logger)
+		with reportLock:
+			summaries[id(mapping)] = summary
+			writeRunReport(theConfig, appConfig, list(summaries.values()), logger)
+
+	while True:
+		if theMatch.lookupCache is not None:
+			saveLookupCache(theMatch.lookupCache, logger)
+		sourceConfigs, mappings = loadConfigs(theConfig, logger)
+		with reportLock:
+			summaries.clear()
+		# sources whose config hasn't changed keep their loaded source object
+		registry = SourceRegistry(sourceConfigs, mappings, logger, keepLoaded=True, previous=registry)
+		if syncState is not None:
+			syncState.retain(mappings)
+		if not len(mappings):
+			logger.error('There are no mappings configured. Please add a properly formatted mapping node to the mapping.json file.')
+
+		logger.info('Scheduling {} mappings'.format(len(mappings)))
+		scheduler = Scheduler(mappings, runScheduledMapping, appConfig.get('scheduleInterval', 60), appConfig.get('mappingWorkers', 4), logger)
+		if len(mappings):
+			scheduler.runUntil(time.monotonic() + appConfig.get('configRefreshInterval', 3600))
+		else:
+			time.sleep(appConfig.get('configRefreshInterval', 3600))
+
+def logSummary(summary, logger):
+	if summary['status'] == 'failed':
+		logger.error('Mapping for sheet {} failed: {}'.format(summary['sheetId'], summary['error']))
+	elif summary['status'] == 'skipped':
+		logger.info('Mapping for sheet {} skipped: {}'.format(summary['sheetId'], summary['error']))
+	else:
+		logger.info('Mapping for sheet %s (%s): %d rows looked up, %d failed lookups, %d updated, %d deleted, %d created, %d failed rows in %.2fs', summary['sheetId'], summary['sheetName'], summary['lookups'], summary['failedLookups'], summary['updated'], summary['deleted'], summary['created'], summary['failedRows'], summary['seconds'])
+		logger.info('Mapping for sheet %s phases: %s', summary['sheetId'], ', '.join('{} {:.2f}s'.format(phase, seconds) for phase, seconds in summary['phases'].items()))
+
+def saveLookupCache(lookupCache, logger):
+	for sourceId, stats in lookupCache.getStats().items():
+		logger.info('Lookup cache for source {}: {} hits, {} misses'.format(sourceId, stats['hits'], stats['misses']))
+	lookupCache.save()
 
-		for mapping in mappings:
-			rowsUpdatePayload = []
-			rowsDeletePayload = []
-			rowsCreatePayload = []
-			# get sheet
-			getSheetUrl = API_URL + "/sheets/" + str(mapping['sheetId'])
-			getSheetResponse = requests.get(getSheetUrl, headers=headers)
-			logger.info('get sheet response for {}: {}'.format(str(mapping['sheetId']), getSheetResponse.status_code))
-			if getSheetResponse.status_code == 200:
-				theSheet = getSheetResponse.json()
+def writeRunReport(theConfig, appConfig, summaries, logger):
+	"""
+	Saves the mapping summaries and the metrics as JSON to runReportFile, and the metrics
+	in the Prometheus text format to prometheusFile when it is set.
+	Both are relative to the settings directory.
+	"""
+	settingsDir = os.path.join(theConfig.baseDir, theConfig.configDir)
+	runReportFile = appConfig.get('runReportFile', 'runReport.json')
+
+	try:
+		if runReportFile:
+			report = dict(metrics.runMetrics.getReport(), finished=time.time(), mappings=summaries)
+			metrics.writeFile(os.path.join(settingsDir, runReportFile), json.dumps(report, indent=2, default=str))
+		if appConfig.get('prometheusFile'):
+			metrics.writeFile(os.path.join(settingsDir, appConfig['prometheusFile']), metrics.runMetrics.getPrometheusText())
+	except OSError as error_message:
+		logger.error('Unable to write the run report: {}'.format(error_message))
+
+def runMapping(mapping, registry, appConfig, apiClient, headers, theMatch, logger, syncState=None):
+	"""
+	Runs processMapping, turning any error into a failed summary so other mappings keep going.
+	The run's time and row counts are added to the metrics.
+	"""
+	start = time.perf_counter()
+	try:
+		summary = processMapping(mapping, registry, appConfig, apiClient, headers, theMatch, logger, syncState)
+	except Exception as error_message:
+		logger.error('Unexpected error updating sheet {}: {}'.format(mapping['sheetId'], error_message), exc_info=True)
+		summary = {'sheetId': mapping['sheetId'], 'status': 'failed', 'error': str(error_message)}
+	finally:
+		for sourceId in set(mappingSource['sourceId'] for mappingSource in mapping['sources']):
+			registry.release(sourceId)
+
+	summary['seconds'] = time.perf_counter() - start
+	recordSummary(summary)
+	return summary
+
+def recordSummary(summary):
+	metrics.runMetrics.increment('mapping_runs', sheetId=summary['sheetId'], status=summary['status'])
+	metrics.runMetrics.observe('mapping_seconds', summary['seconds'], sheetId=summary['sheetId'])
+	for action in ('updated', 'deleted', 'created', 'failedRows'):
+		if summary.get(action):
+			metrics.runMetrics.increment('rows', summary[action], sheetId=summary['sheetId'], action=action)
+
+def processMapping(mapping, registry, appConfig, apiClient, headers, theMatch, logger, syncState=None):
+	"""
+	Fetches the mapping's sheet, reconciles it against its sources and writes the changes.
+
+	syncState remembers the mapping's last successful run. When it is passed in, the run is
+	skipped if the sheet version and every source fingerprint match the last run. If only the
+	sheet changed, just the rows modified since the last run are looked up again, while new
+	rows are still found from the whole sheet. Sources without a getFingerprint method can't
+	tell if they changed, so mappings that use them always reconcile every row.
+
+	Returns a summary of the mapping:
+		sheetId, sheetName, status ('ok', 'skipped' or 'failed'), error
+		lookups, failedLookups -- rows looked up in the sources and lookups that failed
+		updated, deleted, created, failedRows -- row counts from the writes
+		phases -- seconds spent in each phase of the run, also added to the phase_seconds metric
+	"""
+	summary = {'sheetId': mapping['sheetId'], 'sheetName': None, 'status': 'failed', 'error': None, 'lookups': 0, 'failedLookups': 0, 'updated': 0, 'deleted': 0, 'created': 0, 'failedRows': 0, 'phases': {}}
+	getSheetUrl = appConfig['apiURL'] + "/sheets/" + str(mapping['sheetId'])
+
+	# only the sources this mapping uses are loaded
+	sources = {}
+	for mappingSource in mapping['sources']:
+		with timePhase(summary, 'sourceLoad', sourceId=mappingSource['sourceId']):
+			sources[mappingSource['sourceId']] = registry.acquire(mappingSource['sourceId'])
+
+	state = syncState.getState(mapping) if syncState is not None else {}
+	fingerprints = getSourceFingerprints(mapping, sources)
+	sourcesUnchanged = None not in fingerprints.values() and state.get('fingerprints') == fingerprints
+
+	if syncState is not None:
+		with timePhase(summary, 'versionCheck'):
+			version = getSheetVersion(apiClient, getSheetUrl, headers)
+		if version is not None and state.get('version') == version and sourcesUnchanged:
+			summary['status'] = 'skipped'
+			summary['error'] = 'sheet version {} and sources unchanged'.format(version)
+			return summary
+
+	rowsUpdatePayload = []
+	rowsDeletePayload = []
+	rowsCreatePayload = []
+	# only the lookup and output columns are read from the sheet
+	columnTitles = set()
+	for mappingSource in mapping['sources']:
+		if 'sheetColumn' in mappingSource['lookupMapping']:
+			columnTitles.add(mappingSource['lookupMapping']['sheetColumn'])
+		for outMap in mappingSource['outputMappings']:
+			columnTitles.add(outMap['sheetColumn'])
+
+	# get sheet
+	sheetReader = SheetReader(apiClient, appConfig['apiURL'], headers, appConfig.get('sheetPageSize', 5000))
+	try:
+		with timePhase(summary, 'sheetRead'):
+			theSheet = sheetReader.read(mapping['sheetId'], columnTitles)
+	except requests.exceptions.HTTPError as error_message:
+		statusCode = error_message.response.status_code
+		logger.error('There was a problem getting sheet {}. '.format(mapping['sheetId']))
+		logger.error('API Response Status Code: {}'.format(statusCode))
+
+		if statusCode == 403:
+			logger.error('Access forbidden. Probably forgot to add your API Access Token to main.py')
+		elif statusCode == 404:
+			logger.error('Sheet not found. Make sure the sheetId value in mapping.json is correct.')
+		summary['error'] = 'API Response Status Code: {}'.format(statusCode)
+		return summary
+	except (requests.exceptions.RequestException, RuntimeError) as error_message:
+		logger.error('There was a problem getting sheet {}: {}'.format(mapping['sheetId'], error_message))
+		summary['error'] = str(error_message)
+		return summary
+	logger.info('Read {} rows and {} of {} columns of sheet {}'.format(len(theSheet), len(theSheet.values), len(theSheet.columns), mapping['sheetId']))
+
+	logger.info('Updating sheet: {}'.format(theSheet.name))
+	summary['sheetName'] = theSheet.name
+
+	with timePhase(summary, 'sheetIndex'):
+		sheetIndex = SheetIndex(theSheet)
+
+	# mapping columnIds with column names to make mapping.json more readable
+	for mappingSource in mapping['sources']:
+		lookupMapping = mappingSource['lookupMapping']
+		if 'sheetColumn' in lookupMapping:
+			lookupMapping['sheetColumnId'] = sheetIndex.getColumnId(lookupMapping['sheetColumn'])
+			if lookupMapping['sheetColumnId'] is None:
+				del lookupMapping['sheetColumnId']
+				logger.error('Lookup column {} not found in sheet {}'.format(lookupMapping['sheetColumn'], theSheet.name))
+				summary['error'] = 'Lookup column {} not found'.format(lookupMapping['sheetColumn'])
+				return summary
+
+		for outMap in mappingSource['outputMappings']:
+			outMap['sheetColumnId'] = sheetIndex.getColumnId(outMap['sheetColumn'])
+			if outMap['sheetColumnId'] is None:
+				# a column removed since the last run mustn't keep its old id
+				del outMap['sheetColumnId']
+				logger.warning('Output column {} not found in sheet {}'.format(outMap['sheetColumn'], theSheet.name))
+
+	# rows nobody has touched since the last run are still in sync with sources that haven't changed
+	matchSheet = theSheet
+	if sourcesUnchanged and 'rows' in state:
+		changedRows = []
+		for position, rowId in enumerate(theSheet.rowIds):
+			if theSheet.modifiedAt[position] is None or state['rows'].get(str(rowId)) != theSheet.modifiedAt[position]:
+				changedRows.append(position)
+		matchSheet = theSheet.subset(changedRows)
+		logger.info('{} of {} rows changed since the last run'.format(len(matchSheet), len(theSheet)))
+
+	# reconcile each mapping source against the whole sheet at once
+	rowsCells = {}
+	deletedRows = set()
+	# rows whose lookup failed in any source
+	unresolvedRows = set()
+	for mappingSource in mapping['sources']:
+		logger.info('Source: {}'.format(mappingSource['sourceId']))
+		currentSource = sources[mappingSource['sourceId']]
+
+		# rows to update and delete
+		with timePhase(summary, 'match', sourceId=mappingSource['sourceId']):
+			matchedCells, unmatchedRows, failedLookupRows = theMatch.findMatches(matchSheet, currentSource, mappingSource, logger, summary)
+		unresolvedRows.update(failedLookupRows)
+		for rowId, cells in matchedCells.items():
+			rowsCells.setdefault(rowId, []).extend(cells)
+		for rowId in unmatchedRows:
+			if rowId not in deletedRows:
+				deletedRows.add(rowId)
+				rowsDeletePayload.append(rowId)
+
+		# new rows
+		with timePhase(summary, 'findMissing', sourceId=mappingSource['sourceId']):
+			cellsPayload = theMatch.findAllMissing(theSheet, currentSource, mappingSource, logger)
+		rowsCreatePayload.extend(cellsPayload)
+
+	# only send the cells that changed, rows being deleted don't need updating
+	with timePhase(summary, 'diff'):
+		for rowId, cells in rowsCells.items():
+			if rowId in deletedRows:
+				continue
+			cellsPayload = theMatch.diffCells(sheetIndex, rowId, cells)
+			if len(cellsPayload):
+				rowsUpdatePayload.append({'id': rowId, 'cells': cellsPayload})
+	logger.info('{} of {} rows have changed cells'.format(len(rowsUpdatePayload), len(theSheet)))
+
+	payloads = [{'method': 'put', 'payload': rowsUpdatePayload}, {'method': 'delete', 'payload': rowsDeletePayload}, {'method': 'post', 'payload': rowsCreatePayload}]
+	writeRequests = 0
+	for payload in payloads:
+		if len(payload['payload']):
+			with timePhase(summary, 'write', method=payload['method']):
+				report = sendBatches(apiClient, getSheetUrl + '/rows', payload['payload'], headers, payload['method'], appConfig.get('writeBatchSize', 500))
+			writeRequests += report['batches']
+			# output api response
+			summary[{'put': 'updated', 'delete': 'deleted', 'post': 'created'}[payload['method']]] = report['succeeded']
+			summary['failedRows'] += report['failed']
+			if report['failed'] == 0:
+				logger.info('Sheet {} Updated: {} {} rows in {} batches'.format(theSheet.name, payload['method'], report['succeeded'], report['batches']))
 			else:
-				logger.error('There was a problem getting sheet {}. '.format(mapping['sheetId']))
-				logger.error('API Response Status Code: {}'.format(getSheetResponse.status_code))
-
-				if getSheetResponse.status_code == 403:
-					logger.error('Access forbidden. Probably forgot to add your API Access Token to main.py')
-				elif getSheetResponse.status_code == 404:
-					logger.error('Sheet not found. Make sure the sheetId value in mapping.json is correct.')
-				break
-
-			logger.info('Updating sheet: {}'.format(theSheet['name']))
-
-			# mapping columnIds with column names to make mapping.json more readable
-			for mappingSource in mapping['sources']:
-				# loop over all columns in sheet
-				for col in theSheet['columns']:
-
-
-					# check if column is lookup column
-					if 'sheetColumn' in mappingSource['lookupMapping'] and mappingSource['lookupMapping']['sheetColumn'] == col['title'] :
-						mappingSource['lookupMapping']['sheetColumnId'] = col['id']
-					else:
-						# check if column is output column
-						for outMap in mappingSource['outputMappings']:
-							if outMap['sheetColumn'] == col['title']:
-								outMap['sheetColumnId'] = col['id']
-
-				if 'sheetColumnId' not in mappingSource['lookupMapping'] and 'sheetColumn' in mappingSource['lookupMapping']:
-					logger.error('Lookup column {} not found in sheet {}'.format(mappingSource['lookupMapping']['sheetColumn'], theSheet['name']))
-					theConfig.endBadly()
-
-				for outM in mappingSource['outputMappings']:
-
-					if 'sheetColumnId' not in outM:
-						logger.warning('Output column {} not found in sheet {}'.format(outM['sheetColumn'], theSheet['name']))
-
-			for source in sourceConfigs:
-				if source['cloud'] == True:
-					module = __import__('connectors.{}'.format(source['connectorClassName']), fromlist=[source['connectorClassName']])
-					sourceClass = getattr(module, source['connectorClassName'])
-					source['sourceObject'] = sourceClass(source)
-
-			# row update and delete loop
-			for sheetRow in theSheet['rows']:
-				cellsPayload = [] # init payload
-
-				for mappingSource in mapping['sources']:
-					logger.info('Source: {}'.format(mappingSource['sourceId']))
-
-					for source in sourceConfigs:
-						if source['sourceId'] == mappingSource['sourceId']:
-							currentSource = source
-							break
-					if 'lookupByRowId' in mappingSource['lookupMapping'] and mappingSource['lookupMapping']['lookupByRowId'] == True:
-						# lookup by rowId
-						matches = theMatch.findMatch(sheetRow['id'], theSheet['name'], currentSource, mappingSource, mappingSource['lookupMapping']['sourceKey'], logger)
-						if matches != 'Delete':
-							cellsPayload.extend(matches)
-						else:
-							rowsDeletePayload.append(sheetRow['id'])
-					else:
-						for cell in sheetRow['cells']:
-							# find lookup value match
-							if cell['columnId'] == mappingSource['lookupMapping']['sheetColumnId']:
-
-								if 'displayValue' in cell:
-									matches = theMatch.findMatch(cell['displayValue'], theSheet['name'], currentSource, mappingSource, mappingSource['lookupMapping']['sourceKey'], logger)
-									if matches != 'Delete':
-										cellsPayload.extend(matches)
-									else:
-										rowsDeletePayload.append(sheetRow['id'])
-
-				rowsUpdatePayload.append({'id': sheetRow['id'], 'cells': cellsPayload})
-
-			# new row loop
-			for mappingSource in mapping['sources']:
-				logger.info('Source: {}'.format(mappingSource['sourceId']))
-
-				for source in sourceConfigs:
-					if source['sourceId'] == mappingSource['sourceId']:
-						currentSource = source
-						break
-
-				cellsPayload = theMatch.findAllMissing(theSheet, currentSource, mappingSource, logger)
-				rowsCreatePayload.extend(cellsPayload)
-
-			payloads = [{'method': 'put', 'payload': rowsUpdatePayload}, {'method': 'delete', 'payload': rowsDeletePayload}, {'method': 'post', 'payload': rowsCreatePayload}]
-			for payload in payloads:
-				if len(payload['payload']):
-					attempt = 0
-					updateResponse = sendUpdate(getSheetUrl + '/rows', data=payload['payload'], headers=headers, attempt=attempt, method=payload['method'])
-					# output api response
-					try:
-						if updateResponse.status_code == 200:
-							logger.info('Sheet {} Updated'.format(theSheet['name']))
-						else:
-							logger.warning('updateResponse for method {}: {}'.format(payload['method'], updateResponse.text))
-					except AttributeError:
-						logger.error(updateResponse)
-		logger.info('===Smartsheet Data Tracker Utility Completed: {}'.format(str(datetime.datetime.now()).split('.')[0]))
+				logger.warning('updateResponse for method {}: {} of {} rows failed in {} batches'.format(payload['method'], report['failed'], report['rows'], report['batches']))
+				# a bad column can reject every row, so only a sample of the failed items is logged
+				for failedItem in report['failedItems'][:MAX_LOGGED_FAILED_ITEMS]:
+					logger.warning('failedItem for method %s: %s', payload['method'], failedItem)
+				if len(report['failedItems']) > MAX_LOGGED_FAILED_ITEMS:
+					logger.warning('%d more failedItems for method %s not logged', len(report['failedItems']) - MAX_LOGGED_FAILED_ITEMS, payload['method'])
+				for error in report['errors']:
+					logger.error(error)
+
+	if syncState is not None and summary['failedRows'] == 0:
+		# remember the version the sheet was read at, so edits made while the run was going are reconciled next run.
+		# each write request adds one to the version, so when nobody else wrote in the meantime the version
+		# after our own writes is kept instead and they don't count as a change next run
+		savedVersion = theSheet.version if theSheet.version is not None else version
+		if len(unresolvedRows):
+			# a run with failed lookups mustn't be skipped next time, its rows with failed lookups still need reconciling
+			savedVersion = None
+		elif writeRequests and savedVersion is not None:
+			writtenVersion = getSheetVersion(apiClient, getSheetUrl, headers)
+			if writtenVersion == savedVersion + writeRequests:
+				savedVersion = writtenVersion
+		# rows we wrote get a new modifiedAt, leave them out so they are checked once more.
+		# rows whose lookup failed are left out too so they are looked up again next run
+		updatedRows = set(row['id'] for row in rowsUpdatePayload)
+		rows = {}
+		for rowId, modifiedAt in zip(theSheet.rowIds, theSheet.modifiedAt):
+			if rowId not in updatedRows and rowId not in deletedRows and rowId not in unresolvedRows:
+				rows[str(rowId)] = modifiedAt
+		with timePhase(summary, 'saveState'):
+			syncState.setState(mapping, {'version': savedVersion, 'fingerprints': fingerprints, 'rows': rows})
+			syncState.save()
+
+	summary['status'] = 'ok'
+	return summary
+
+@contextlib.contextmanager
+def timePhase(summary, phase, **labels):
+	"""
+	Adds the seconds spent in the block to the mapping summary's phases and to the phase_seconds metric
+	"""
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		seconds = time.perf_counter() - start
+		summary['phases'][phase] = summary['phases'].get(phase, 0) + seconds
+		metrics.runMetrics.observe('phase_seconds', seconds, sheetId=summary['sheetId'], phase=phase, **labels)
+
+def getSheetVersion(apiClient, sheetUrl, headers):
+	"""
+	Returns the current version of the sheet, or None if it couldn't be read
+	"""
+	try:
+		versionResponse = apiClient.get(sheetUrl + '/version', headers=headers)
+		if versionResponse.status_code == 200:
+			return versionResponse.json()['version']
+	except (requests.exceptions.RequestException, ValueError, KeyError):
+		pass
+	return None
+
+def getSourceFingerprints(mapping, sources):
+	"""
+	Returns a dict of sourceId to the source's fingerprint for each of the mapping's sources.
+	The fingerprint is None for sources that can't tell whether their data changed, and for
+	sources with an isPreloaded method when the mapping looks up on a key that wasn't preloaded,
+	as those lookups go to the server.
+	"""
+	fingerprints = {}
+
+	for sourceId, source in sources.items():
+		fingerprints[sourceId] = None
+		if hasattr(source['sourceObject'], 'getFingerprint'):
+			fingerprints[sourceId] = source['sourceObject'].getFingerprint()
+
+	for mappingSource in mapping['sources']:
+		sourceObject = sources[mappingSource['sourceId']]['sourceObject']
+		if hasattr(sourceObject, 'isPreloaded') and not sourceObject.isPreloaded(mappingSource['lookupMapping']['sourceKey']):
+			fingerprints[mappingSource['sourceId']] = None
+
+	return fingerprints
+
+def sendBatches(apiClient, updateUrl, data, headers, method, batchSize):
+	"""
+	Splits a row payload into batches and sends them one after another.
+	PUT and POST payloads are split into batches of batchSize rows,
+	DELETE payloads into batches of ids that fit in the request URL.
+	Smartsheet turns away a write while another write to the same sheet is in progress,
+	so batches for one sheet are never sent at the same time.
+
+	Returns a single report for all batches:
+		method, rows, batches, succeeded, failed
+		failedItems -- the failedItems Smartsheet returns for rows rejected in a partial success
+		errors -- responses and exceptions for batches that failed outright
+	"""
+	method = method.upper()
+	if method == 'DELETE':
+		batches = list(chunkURI(updateUrl + '?ids=&ignoreRowsNotFound=true', data))
 	else:
-		logger.error('There are no mappings configured. Please add a properly formatted mapping node to the mapping.json file.')
+		batches = [data[start:start + batchSize] for start in range(0, len(data), batchSize)]
+
+	report = {'method': method, 'rows': len(data), 'batches': len(batches), 'succeeded': 0, 'failed': 0, 'failedItems': [], 'errors': []}
 
-def sendUpdate(updateUrl, data, headers, attempt, method):
+	for batch in batches:
+		updateResponse = sendUpdate(apiClient, updateUrl, batch, headers, method)
+		try:
+			statusCode = updateResponse.status_code
+		except AttributeError:
+			# retries ran out and the exception came back instead of a response
+			report['failed'] += len(batch)
+			report['errors'].append(str(updateResponse))
+			continue
+
+		if statusCode == 200:
+			try:
+				failedItems = updateResponse.json().get('failedItems', [])
+			except ValueError:
+				failedItems = []
+			report['failedItems'].extend(failedItems)
+			report['failed'] += len(failedItems)
+			report['succeeded'] += len(batch) - len(failedItems)
+		else:
+			report['failed'] += len(batch)
+			report['errors'].append('{} {}: {}'.format(statusCode, method, updateResponse.text))
+
+	return report
+
+def sendUpdate(apiClient, updateUrl, data, headers, method):
+	"""
+	Sends one batch of rows. Returns the response, or the exception if the request could not be sent after retries.
+	"""
 	method = method.upper()
 	try:
 		if method == 'DELETE':
-			updateUrl = updateUrl + '?ids='
-			for req in chunkURI(updateUrl, data):
-				updateResponse = requests.request(method, updateUrl + req + '&ignoreRowsNotFound=true', headers=headers)
+			deleteUrl = updateUrl + '?ids=' + ','.join(str(rowId) for rowId in data) + '&ignoreRowsNotFound=true'
+			updateResponse = apiClient.request(method, deleteUrl, headers=headers)
 		else:
-			# send update to smartsheet for each row
-			updateResponse = requests.request(method, updateUrl, data=json.dumps(data), headers=headers)
-	except requests.exceptions.ConnectionError as error_message:
-		time.sleep(3)
-		# send update to smartsheet for each row
-		updateResponse = sendUpdateRetry(updateUrl, data, headers, attempt, method, error_message)
+			# rows that fail validation are reported in failedItems instead of failing the whole batch
+			updateResponse = apiClient.request(method, updateUrl + '?allowPartialSuccess=true', data=json.dumps(data), headers=headers)
+	except requests.exceptions.RequestException as error_message:
+		updateResponse = error_message
 	return updateResponse
 
-def sendUpdateRetry(updateUrl, payload, headers, attempt, method, exception):
-	maxAttempts = 3
-	response = {}
-
-	print('updateRetry')
-	if attempt < maxAttempts:
-		attempt = attempt + 1
-		response = sendUpdate(updateUrl, payload, headers, attempt, method)
-	else:
-		response = exception
-	return response
-
 def chunkURI(baseURL, params: list):
+	"""
+	Splits params into lists whose comma separated values fit in the URL after baseURL
+	"""
 	# capped at 2000 characters for wide range support as Smartsheet doesn't tell us what the limit is
 	maxCharacters = 2000
 	availableCharacters = maxCharacters - len(baseURL)
-	chunk = ''
+	chunk = []
+	chunkLength = 0
 
 	for param in params:
-		param = str(param)
 		# add 1 magic number to account for the comma that will be appended
-		if len(chunk) + len(param) + 1 < availableCharacters:
-			chunk += "{},".format(param)
-		else:
-			yield chunk[:-1]
-			# since we iterated, we need to use the item so we don't lose it
+		paramLength = len(str(param)) + 1
+		if len(chunk) and chunkLength + paramLength >= availableCharacters:
+			yield chunk
 			# clear and set the current param after yielding the max length
-			chunk = "{},".format(param)
+			chunk = []
+			chunkLength = 0
+		chunk.append(param)
+		chunkLength += paramLength
 
 	# yield the last chunk
-	yield chunk[:-1]
-
-def findSheetMatch(sheet, lookupVal: any, lookupKey: int):
-	"""
-	Should find a match in the stored sheet data based on the target value and the column id
-	Should return a bool indicating if a match was found
-	"""
-
-	for sheetRow in sheet['rows']:
-		for cell in sheetRow['cells']:
-			if cell['columnId'] == lookupKey and cell['value'] == lookupVal:
-				return True
-
-	return False
-
+	if len(chunk):
+		yield chunk
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,229 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+import os
+import time
+import pickle
+import hashlib
+import threading
+import collections
+import pandas as pd
+from utils import lookup
+from utils.registry import getSourceSignature
+from utils.metrics import runMetrics
+
+class AttachmentCache:
+	"""
+	On disk cache of parsed sheet attachments, so an attachment that hasn't changed
+	is never downloaded or parsed again. Entries are keyed on the attachment's id,
+	upload time and size, and stored as pickled DataFrames.
+
+	Once the cache grows past maxBytes the least recently used entries are removed.
+	A maxBytes of 0 turns the cache off.
+	"""
+	def __init__(self, cacheDir, maxBytes, logger):
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+		self.logger = logger
+		self.lock = threading.Lock()
+
+	def getPath(self, attachment):
+		key = '{}:{}:{}'.format(attachment['id'], attachment.get('createdAt'), attachment.get('sizeInKb'))
+		return os.path.join(self.cacheDir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+	def get(self, attachment):
+		"""
+		Returns the cached DataFrame for the attachment, None if it isn't cached
+		"""
+		if not self.maxBytes:
+			return None
+
+		path = self.getPath(attachment)
+		try:
+			data = pd.read_pickle(path)
+			# the modified time of an entry is when it was last used
+			os.utime(path)
+		except FileNotFoundError:
+			runMetrics.increment('cache_requests', cache='attachment', result='miss')
+			return None
+		except Exception as error_message:
+			self.logger.warning('Unable to read cached attachment {}: {}'.format(attachment['name'], error_message))
+			runMetrics.increment('cache_requests', cache='attachment', result='miss')
+			return None
+
+		self.logger.info('Loaded attachment {} from cache'.format(attachment['name']))
+		runMetrics.increment('cache_requests', cache='attachment', result='hit')
+		return data
+
+	def put(self, attachment, data):
+		if not self.maxBytes:
+			return
+
+		path = self.getPath(attachment)
+		with self.lock:
+			try:
+				os.makedirs(self.cacheDir, exist_ok=True)
+				data.to_pickle(path + '.tmp')
+				os.replace(path + '.tmp', path)
+			except Exception as error_message:
+				self.logger.warning('Unable to cache attachment {}: {}'.format(attachment['name'], error_message))
+				return
+
+			self.evict()
+
+	def evict(self):
+		entries = []
+		for fileName in os.listdir(self.cacheDir):
+			if fileName.endswith('.pkl'):
+				fileStat = os.stat(os.path.join(self.cacheDir, fileName))
+				entries.append((fileStat.st_mtime, fileStat.st_size, fileName))
+
+		totalBytes = sum(entry[1] for entry in entries)
+		for modified, size, fileName in sorted(entries):
+			if totalBytes <= self.maxBytes:
+				break
+			try:
+				os.remove(os.path.join(self.cacheDir, fileName))
+				totalBytes -= size
+			except OSError:
+				pass
+
+class LookupCache:
+	"""
+	Remembers what each source returned for a lookup value, so a value shared by many rows
+	and mappings is only looked up again once its entry expires. Each source sets how long
+	matches are kept with lookupCacheTTL and misses with lookupCacheMissTTL in sources.json.
+	Failed lookups are never kept.
+
+	Entries are keyed on the source's config as well as its id, so changing a source's config
+	never serves entries from the old one. Once maxEntries is reached the least recently used
+	entry is dropped. With a filePath the entries are saved between runs.
+	"""
+	def __init__(self, maxEntries, logger, filePath=None, clock=time.time):
+		self.maxEntries = maxEntries
+		self.logger = logger
+		self.filePath = filePath
+		self.clock = clock
+		# (namespace, lookupKey, lookupVal) to (expires, record), least recently used first
+		self.entries = collections.OrderedDict()
+		# sourceId to {hits, misses}
+		self.stats = {}
+		self.lock = threading.Lock()
+
+		if self.filePath is not None:
+			self.load()
+
+	def getMany(self, namespace, lookupKey, lookupVals):
+		"""
+		 Returns a tuple of (records, remainingVals) where records maps the cached lookup values
+		 to their record, or an empty list for a cached miss, and remainingVals are the values to look up.
+		"""
+		records = {}
+		remainingVals = []
+		now = self.clock()
+
+		with self.lock:
+			for lookupVal in lookupVals:
+				key = (namespace, lookupKey, lookupVal)
+				entry = self.entries.get(key)
+				if entry is not None and entry[0] > now:
+					self.entries.move_to_end(key)
+					records[lookupVal] = entry[1]
+				else:
+					if entry is not None:
+						del self.entries[key]
+					remainingVals.append(lookupVal)
+
+			sourceId = namespace.rsplit(':', 1)[0]
+			stats = self.stats.setdefault(sourceId, {'hits': 0, 'misses': 0})
+			stats['hits'] += len(records)
+			stats['misses'] += len(remainingVals)
+
+		runMetrics.increment('cache_requests', len(records), cache='lookup', sourceId=sourceId, result='hit')
+		runMetrics.increment('cache_requests', len(remainingVals), cache='lookup', sourceId=sourceId, result='miss')
+		return records, remainingVals
+
+	def putMany(self, namespace, lookupKey, records, ttl, missTTL):
+		"""
+		 Keeps each record for ttl seconds, or for missTTL seconds when it is empty or None.
+		 Records marked as lookup.FAILED, or with a TTL of 0, are left out.
+		"""
+		now = self.clock()
+
+		with self.lock:
+			for lookupVal, record in records.items():
+				if record is lookup.FAILED:
+					continue
+				if record is None or not len(record):
+					record, entryTTL = [], missTTL
+				else:
+					entryTTL = ttl
+
+				if entryTTL > 0:
+					key = (namespace, lookupKey, lookupVal)
+					self.entries[key] = (now + entryTTL, record)
+					self.entries.move_to_end(key)
+
+			while len(self.entries) > self.maxEntries:
+				self.entries.popitem(last=False)
+
+	def getStats(self):
+		with self.lock:
+			return {sourceId: dict(stats) for sourceId, stats in self.stats.items()}
+
+	def load(self):
+		try:
+			with open(self.filePath, 'rb') as cacheFile:
+				entries = pickle.load(cacheFile)
+		except FileNotFoundError:
+			return
+		except Exception as error_message:
+			# a damaged cache file only costs the lookups it held
+			self.logger.warning('Ignoring lookup cache in {}: {}'.format(self.filePath, error_message))
+			return
+
+		now = self.clock()
+		with self.lock:
+			for key, entry in entries:
+				if entry[0] > now:
+					self.entries[key] = entry
+			while len(self.entries) > self.maxEntries:
+				self.entries.popitem(last=False)
+
+	def save(self):
+		"""
+		 Writes the entries that haven't expired to filePath, when there is one
+		"""
+		if self.filePath is None:
+			return
+
+		now = self.clock()
+		with self.lock:
+			entries = [(key, entry) for key, entry in self.entries.items() if entry[0] > now]
+
+		try:
+			# write to a temporary file first so a crash can't leave half a cache file behind
+			with open(self.filePath + '.tmp', 'wb') as cacheFile:
+				pickle.dump(entries, cacheFile, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(self.filePath + '.tmp', self.filePath)
+		except (OSError, pickle.PicklingError, TypeError, AttributeError) as error_message:
+			self.logger.error('Unable to save the lookup cache to {}: {}'.format(self.filePath, error_message))
+
+def getNamespace(source):
+	"""
+	Returns the id the lookup cache files a source's entries under, its sourceId and a hash of its config
+	"""
+	return '{}:{}'.format(source['sourceId'], hashlib.sha1(getSourceSignature(source).encode('utf-8')).hexdigest()[:12])
@@ -0,0 +1,202 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+import re
+import time
+import random
+import threading
+import email.utils
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from utils.metrics import runMetrics
+
+# status codes that mean the request can be sent again
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# a POST that hit a server error may already have created rows, so only retry when it was turned away
+RETRY_POST_STATUS_CODES = (429, 503)
+
+clients = {}
+clientsLock = threading.Lock()
+
+def getClient(appConfig):
+	"""
+	Returns the Client shared by everything that talks to appConfig['apiURL'],
+	so the connection pool, rate limiter and retry counts cover the whole process.
+	"""
+	with clientsLock:
+		if appConfig['apiURL'] not in clients:
+			clients[appConfig['apiURL']] = Client(appConfig)
+		return clients[appConfig['apiURL']]
+
+def wasSent(error):
+	"""
+	Returns False when a request failed before it reached the server, i.e. it timed out
+	connecting or no connection could be made. Any other error, like a read timeout or a
+	dropped connection, may have come after the server got the request.
+	"""
+	if isinstance(error, requests.exceptions.ConnectTimeout):
+		return False
+	reason = getattr(error.args[0], 'reason', None) if len(error.args) else None
+	return not isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+class RateLimiter:
+	"""
+	Token bucket that allows requestsPerMinute on average with bursts of up to burst requests.
+	"""
+	def __init__(self, requestsPerMinute, burst, clock=time.monotonic, sleep=time.sleep):
+		self.rate = requestsPerMinute / 60.0
+		self.capacity = float(max(1, burst))
+		self.tokens = self.capacity
+		self.clock = clock
+		self.sleep = sleep
+		self.updated = clock()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = self.clock()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			self.sleep(wait)
+
+class Client:
+	"""
+	HTTP client with a pooled keep-alive session, exponential backoff, Retry-After support
+	and a token bucket rate limiter for requests to the Smartsheet API.
+
+	App config settings, all optional:
+		httpPoolSize -- connections kept open per host, defaults to 10
+		httpKeepAlive -- reuse connections between requests, defaults to true
+		httpTimeout -- seconds to wait to connect and then for a response, as a number or [connect, read], defaults to [10, 120]
+		requestsPerMinute -- average rate of Smartsheet API requests, defaults to 280
+		rateLimitBurst -- requests that can go out back to back before the rate applies, defaults to 10
+		maxRetries -- retries for each request, defaults to 5
+		backoffBase -- seconds to wait before the first retry, doubled for each retry after, defaults to 1
+		backoffMax -- max seconds to wait between retries, defaults to 60
+	"""
+	def __init__(self, appConfig, sleep=time.sleep):
+		self.apiURL = appConfig['apiURL']
+		self.maxRetries = appConfig.get('maxRetries', 5)
+		self.backoffBase = appConfig.get('backoffBase', 1)
+		self.backoffMax = appConfig.get('backoffMax', 60)
+		self.limiter = RateLimiter(appConfig.get('requestsPerMinute', 280), appConfig.get('rateLimitBurst', 10), sleep=sleep)
+		self.sleep = sleep
+		self.timeout = appConfig.get('httpTimeout', [10, 120])
+		if isinstance(self.timeout, list):
+			self.timeout = tuple(self.timeout)
+
+		self.session = requests.Session()
+		poolSize = appConfig.get('httpPoolSize', 10)
+		# retries are handled in request so they can be rate limited and counted
+		adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=0)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+		if not appConfig.get('httpKeepAlive', True):
+			self.session.headers['Connection'] = 'close'
+
+		# retry counts keyed on the endpoint from getEndpoint, with the host for hosts other than the Smartsheet API
+		self.retries = {}
+		self.lock = threading.Lock()
+
+	def request(self, method, url, **kwargs):
+		"""
+		Sends the request, retrying connection errors, timeouts, 429s and 5xx responses.
+		Returns the last response, or raises the last exception once retries run out.
+		A POST is only retried when it never reached the server, as one that timed out
+		waiting for a response may already have created its rows.
+		"""
+		method = method.upper()
+		kwargs.setdefault('timeout', self.timeout)
+		retryStatusCodes = RETRY_POST_STATUS_CODES if method == 'POST' else RETRY_STATUS_CODES
+		host, endpoint = self.getEndpoint(method, url)
+		attempt = 0
+
+		while True:
+			if url.startswith(self.apiURL):
+				with runMetrics.timer('http_rate_limit_wait_seconds', host=host):
+					self.limiter.acquire()
+
+			start = time.perf_counter()
+			try:
+				response = self.session.request(method, url, **kwargs)
+			except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error_message:
+				self.recordRequest(host, endpoint, type(error_message).__name__, start)
+				if attempt >= self.maxRetries or (method == 'POST' and wasSent(error_message)):
+					raise
+				delay = self.getBackoff(attempt)
+			else:
+				self.recordRequest(host, endpoint, response.status_code, start)
+				if response.status_code not in retryStatusCodes or attempt >= self.maxRetries:
+					return response
+				delay = self.getRetryAfter(response)
+				if delay is None:
+					delay = self.getBackoff(attempt)
+
+			self.recordRetry(host, endpoint, url)
+			self.sleep(delay)
+			attempt += 1
+
+	def get(self, url, **kwargs):
+		return self.request('GET', url, **kwargs)
+
+	def getBackoff(self, attempt):
+		# full jitter keeps parallel workers from retrying in lockstep
+		return random.uniform(0, min(self.backoffMax, self.backoffBase * (2 ** attempt)))
+
+	def getRetryAfter(self, response):
+		retryAfter = response.headers.get('Retry-After')
+		if retryAfter is None:
+			return None
+
+		try:
+			delay = float(retryAfter)
+		except ValueError:
+			try:
+				delay = email.utils.parsedate_to_datetime(retryAfter).timestamp() - time.time()
+			except (TypeError, ValueError):
+				return None
+
+		return min(self.backoffMax, max(0, delay)) + random.uniform(0, 1)
+
+	def getEndpoint(self, method, url):
+		"""
+		Returns the host and the endpoint the request is counted under in the metrics.
+		Smartsheet endpoints are the method and path with ids replaced by {id}. Other hosts,
+		like the REST sources, put lookup values in their paths so only the method is kept.
+		"""
+		parts = urlsplit(url)
+		if url.startswith(self.apiURL):
+			return parts.netloc, '{} {}'.format(method, re.sub(r'/\d+', '/{id}', parts.path))
+		return parts.netloc, method
+
+	def recordRequest(self, host, endpoint, status, start):
+		runMetrics.increment('http_requests', host=host, endpoint=endpoint, status=status)
+		runMetrics.observe('http_request_seconds', time.perf_counter() - start, host=host, endpoint=endpoint)
+
+	def recordRetry(self, host, endpoint, url):
+		runMetrics.increment('http_retries', host=host, endpoint=endpoint)
+		# other hosts' endpoints are only the method, so they're told apart by their host
+		key = endpoint if url.startswith(self.apiURL) else '{} {}'.format(endpoint, host)
+		with self.lock:
+			self.retries[key] = self.retries.get(key, 0) + 1
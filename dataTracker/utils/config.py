@@ -19,14 +19,17 @@ import json
 import logging
 import logging.handlers
 import sys
+import queue
+import atexit
 import requests
 from io import StringIO
 
 class Config:
-	def __init__(self, configDir: str = "settings"):
+	def __init__(self, configDir: str = None):
 		loggers = {}
 		self.baseDir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-		self.configDir = configDir
+		# DATATRACKER_SETTINGS points every part of the app at another settings directory
+		self.configDir = configDir or os.environ.get("DATATRACKER_SETTINGS", "settings")
 
 		return None
 
@@ -45,11 +48,14 @@ class Config:
 			print("Please make sure the file contains properly formatted JSON.")
 		return config
 	
-	def getConfigFromURL(self, url):
+	def getConfigFromURL(self, url, apiClient=None):
 		config = []
 
 		try:
-			res = requests.get(url, stream=True)
+			if apiClient is not None:
+				res = apiClient.get(url)
+			else:
+				res = requests.get(url, stream=True)
 			config = res.json()
 		except Exception as e:
 			print("Error loading config from URL. Error: {}".format(e))
@@ -67,12 +73,20 @@ class Config:
 		if not len(logger.handlers):
 			logger.setLevel(eval(appConfig["logLevel"]))
 
-			handler = logging.handlers.RotatingFileHandler(appConfig["logFileName"],mode='a',maxBytes=appConfig['logFileMaxBytes'],backupCount=appConfig['logFileBackupCount'])
+			handler = logging.handlers.RotatingFileHandler(appConfig["logFileName"],mode='a',maxBytes=appConfig.get('logFileMaxBytes', 10485760),backupCount=appConfig['logFileBackupCount'])
 			handler.setLevel(eval(appConfig["logLevel"]))
 
 			formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 			handler.setFormatter(formatter)
 
+			if appConfig.get('logQueue', False):
+				# workers only put records on a queue, a background thread formats and writes them
+				logQueue = queue.Queue(-1)
+				listener = logging.handlers.QueueListener(logQueue, handler, respect_handler_level=True)
+				listener.start()
+				atexit.register(listener.stop)
+				handler = logging.handlers.QueueHandler(logQueue)
+
 			logger.addHandler(handler)
 
 		return logger
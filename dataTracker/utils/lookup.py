@@ -0,0 +1,50 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# marks a lookup that raised, as None is a valid "no match" from some connectors
+FAILED = object()
+
+def findSourceMatchesAsync(findSourceMatch, lookupVals, lookupKey, concurrency, logger):
+	"""
+	Calls findSourceMatch for every lookup value on an asyncio event loop, with at most
+	concurrency lookups in flight. The connectors use blocking HTTP clients, so each
+	lookup runs on a worker thread of its own pool.
+
+	Returns a dict of lookup value to matching record in the order of lookupVals.
+	A lookup that raises is logged and mapped to FAILED, so one bad response
+	doesn't fail the rest of the lookups.
+	"""
+	return asyncio.run(findAll(findSourceMatch, list(lookupVals), lookupKey, max(1, concurrency), logger))
+
+async def findAll(findSourceMatch, lookupVals, lookupKey, concurrency, logger):
+	loop = asyncio.get_running_loop()
+	semaphore = asyncio.Semaphore(concurrency)
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		async def findOne(lookupVal):
+			async with semaphore:
+				try:
+					return lookupVal, await loop.run_in_executor(executor, findSourceMatch, lookupVal, lookupKey)
+				except Exception as error_message:
+					logger.error("Lookup failed for value '%s': %s", lookupVal, error_message)
+					return lookupVal, FAILED
+
+		results = await asyncio.gather(*[findOne(lookupVal) for lookupVal in lookupVals])
+
+	return dict(results)
@@ -20,66 +20,193 @@ import logging
 import logging.handlers
 import sys
 import pandas as pd
+from utils import lookup
+from utils import cache
+from utils.metrics import runMetrics
 
 class Match:
-	def __init__(self):
-		return None
-
-	def findMatch(self, lookupVal, sheetName, source, mappingSource, lookupKey, logger):
+	def __init__(self, lookupCache=None):
+		# cache.LookupCache shared by every mapping, or None to always ask the sources
+		self.lookupCache = lookupCache
+
+	def findMatches(self, sheetData, source, mappingSource, logger, counters=None):
+		"""
+		Resolves every row of the sheet against the source in a single pass.
+		Lookup values are collected from all rows first and handed to the source as a set,
+		so each distinct value is queried once no matter how many rows share it.
+
+		Returns a tuple of (cells, deletes, failed) where cells maps a rowId to its cell payloads,
+		deletes lists the rowIds that have no matching source record and failed lists the rowIds
+		whose lookup failed, which are left as they are.
+		When counters is given, the rows looked up and the lookups that failed are added to
+		its lookups and failedLookups counts.
+		"""
+		cells = {}
+		deletes = []
+		failed = []
+		skipped = {}
+
+		lookupMapping = mappingSource['lookupMapping']
+		rowLookups = self.getLookupValues(sheetData, lookupMapping)
+		lookupVals = set(lookupVal for rowId, lookupVal in rowLookups)
+		with runMetrics.timer('source_lookup_seconds', sourceId=mappingSource['sourceId']):
+			sourceMatches = self.findSourceMatches(source, lookupVals, lookupMapping['sourceKey'], logger)
+		for rowId, lookupVal in rowLookups:
+			# the lookup failed, leave the row as it is rather than treat it as a miss
+			if lookupVal not in sourceMatches:
+				failed.append(rowId)
+				continue
+
+			sourceMatch = sourceMatches[lookupVal]
+			if sourceMatch is not None and len(sourceMatch):
+				cells[rowId] = self.buildCells(sourceMatch, lookupVal, sheetData.name, source, mappingSource, logger, skipped)
+			else:
+				deletes.append(rowId)
+
+		self.logSkipped(skipped, mappingSource['sourceId'], logger)
+		logger.info('Source %s: %d rows, %d distinct lookup values, %d unmatched rows, %d failed lookups', mappingSource['sourceId'], len(rowLookups), len(lookupVals), len(deletes), len(failed))
+		runMetrics.increment('lookup_values', len(lookupVals), sourceId=mappingSource['sourceId'])
+		runMetrics.increment('lookups', len(cells), sourceId=mappingSource['sourceId'], result='matched')
+		runMetrics.increment('lookups', len(deletes), sourceId=mappingSource['sourceId'], result='unmatched')
+		runMetrics.increment('lookups', len(failed), sourceId=mappingSource['sourceId'], result='failed')
+		if counters is not None:
+			counters['lookups'] = counters.get('lookups', 0) + len(rowLookups)
+			counters['failedLookups'] = counters.get('failedLookups', 0) + len(failed)
+
+		return cells, deletes, failed
+
+	def getLookupValues(self, sheetData, lookupMapping):
+		"""
+		Returns a list of (rowId, lookupVal) tuples for every sheet row with a lookup value.
+		Rows are looked up by their id when lookupByRowId is set, otherwise by the display value of the lookup column.
+		"""
+		rowLookups = []
+
+		if 'lookupByRowId' in lookupMapping and lookupMapping['lookupByRowId'] == True:
+			for rowId in sheetData.rowIds:
+				rowLookups.append((rowId, rowId))
+		else:
+			for rowId, displayValue in zip(sheetData.rowIds, sheetData.displayValues[lookupMapping['sheetColumnId']]):
+				if displayValue is not None:
+					rowLookups.append((rowId, displayValue))
+
+		return rowLookups
+
+	def findSourceMatches(self, source, lookupVals, lookupKey, logger):
+		"""
+		Returns a dict of each lookup value to its source record, or an empty record when there is no match.
+		Sources that provide findSourceMatches resolve the whole set at once. Others are queried one value
+		at a time, concurrently when the source sets a concurrency above 1.
+		Lookups the source marks as lookup.FAILED are left out of the dict.
+		Values the lookup cache holds for the source, set with lookupCacheTTL or lookupCacheMissTTL,
+		are not looked up again.
+		"""
+		sourceObject = source['sourceObject']
+		ttl = source.get('lookupCacheTTL', 0)
+		missTTL = source.get('lookupCacheMissTTL', ttl)
+		cached = {}
+
+		if self.lookupCache is not None and (ttl > 0 or missTTL > 0):
+			namespace = cache.getNamespace(source)
+			cached, lookupVals = self.lookupCache.getMany(namespace, lookupKey, lookupVals)
+			if not len(lookupVals):
+				return cached
+
+		if hasattr(sourceObject, 'findSourceMatches'):
+			found = sourceObject.findSourceMatches(lookupVals, lookupKey)
+		elif source.get('concurrency', 1) > 1:
+			found = lookup.findSourceMatchesAsync(sourceObject.findSourceMatch, lookupVals, lookupKey, source['concurrency'], logger)
+		else:
+			found = {lookupVal: sourceObject.findSourceMatch(lookupVal, lookupKey) for lookupVal in lookupVals}
+
+		sourceMatches = {}
+		for lookupVal in lookupVals:
+			sourceMatch = found.get(lookupVal, [])
+			if sourceMatch is not lookup.FAILED:
+				sourceMatches[lookupVal] = sourceMatch
+
+		if self.lookupCache is not None and (ttl > 0 or missTTL > 0):
+			self.lookupCache.putMany(namespace, lookupKey, sourceMatches, ttl, missTTL)
+			sourceMatches.update(cached)
+
+		return sourceMatches
+
+	def diffCells(self, sheetIndex, rowId, cells):
+		"""
+		Returns only the cell payloads whose value differs from the current cell in the row.
+		"""
+		return [cell for cell in cells if self.cellChanged(sheetIndex.getCell(rowId, cell['columnId']), cell['value'])]
+
+	def cellChanged(self, currentCell, value):
+		# blank cells may not have a value or displayValue at all
+		if currentCell is None or ('value' not in currentCell and 'displayValue' not in currentCell):
+			return not (value is None or value == '')
+
+		if 'value' in currentCell and currentCell['value'] == value:
+			return False
+		# the source may hold the same value as a different type, e.g. '5' and 5
+		if 'displayValue' in currentCell and currentCell['displayValue'] == str(value):
+			return False
+
+		return True
+
+	def buildCells(self, sourceMatch, lookupVal, sheetName, source, mappingSource, logger, skipped=None):
+		"""
+		Returns the cell payloads for the outputMappings from the source record.
+		When skipped is given, cells that can't be built are counted in it rather than logged,
+		so a problem shared by every row is logged once by logSkipped.
+		"""
 		payload = []
 
-		logger.info('Searching source for value: {}'.format(lookupVal))
-
-		# sourceMatch is the source record with the matching lookup value
-		sourceMatch = source['sourceObject'].findSourceMatch(lookupVal, lookupKey)
-
-		if len(sourceMatch):
-			logger.info('Match Found')
-
-			for outputMap in mappingSource['outputMappings']:
-				# build put call
-				# - columnId
-				# - value
-				logger.info('outputMap: {}'.format(outputMap))
-				try:
-					payload.append({'columnId': outputMap['sheetColumnId'], 'value': sourceMatch[outputMap['sourceKey']], 'strict':source['isStrict']})
-				except KeyError as error_message:
-
-					if str(error_message) == '\'sheetColumnId\'':
-						logger.warning('The {} was not set for the sheetColumn: {} in source: {}. Verify the sheetColumn value matches the column title in sheet: {}'.format(error_message,outputMap['sheetColumn'],mappingSource['sourceId'],sheetName))
-					else:
-						logger.warning('The sourceKey of {} could not be found in the source {} for {}. {}'.format(outputMap['sourceKey'],mappingSource['sourceId'],lookupVal,error_message))
-				except Exception as error_message:
-						logger.warning(error_message)
-		else:
-			logger.info('No Match')
-			return 'Delete'
+		for outputMap in mappingSource['outputMappings']:
+			# build put call
+			# - columnId
+			# - value
+			try:
+				payload.append({'columnId': outputMap['sheetColumnId'], 'value': sourceMatch[outputMap['sourceKey']], 'strict':source['isStrict']})
+			except KeyError as error_message:
+
+				if str(error_message) == '\'sheetColumnId\'':
+					warning = ('The sheetColumnId was not set for the sheetColumn: %s in source: %s. Verify the sheetColumn value matches the column title in sheet: %s', outputMap['sheetColumn'], mappingSource['sourceId'], sheetName)
+				else:
+					warning = ('The sourceKey of %s could not be found in the source %s', outputMap['sourceKey'], mappingSource['sourceId'])
+				self.skipCell(warning, lookupVal, skipped, logger)
+			except Exception as error_message:
+				self.skipCell(('Unable to build the %s cell from source %s: %s', outputMap['sheetColumn'], mappingSource['sourceId'], type(error_message).__name__), lookupVal, skipped, logger)
 
 		return payload
 
+	def skipCell(self, warning, lookupVal, skipped, logger):
+		if skipped is None:
+			logger.warning(warning[0] + ' for %s', *warning[1:], lookupVal)
+		else:
+			skipped[warning] = skipped.get(warning, 0) + 1
+
+	def logSkipped(self, skipped, sourceId, logger):
+		for warning, rows in skipped.items():
+			runMetrics.increment('cells_skipped', rows, sourceId=sourceId)
+			logger.warning(warning[0] + ' for %d rows', *warning[1:], rows)
+
 	def findAllMissing(self, sheetData, source, mappingSource, logger):
 		payload = []
+		skipped = {}
 
 		lookupMapping = mappingSource["lookupMapping"]
 
+		# sources like databases and APIs can't list their records, and rows looked up by row id have no key to add
+		if not hasattr(source["sourceObject"], "findTargetMissing") or "sheetColumnId" not in lookupMapping:
+			return payload
+
 		missing = source["sourceObject"].findTargetMissing(sheetData, lookupMapping)
 
 		if len(missing):
-			logger.info("Missing rows found")
+			logger.info("%d missing rows found", len(missing))
 
 			for row in missing:
-				cells = []
-				for outputMap in mappingSource["outputMappings"]:
-					try:
-						cells.append({"columnId": outputMap["sheetColumnId"], "value": row[outputMap["sourceKey"]], "strict": source["isStrict"]})
-					except KeyError as error_message:
-						if str(error_message) == '\'sheetColumnId\'':
-							logger.warning('The {} was not set for the sheetColumn: {} in source: {}. Verify the sheetColumn value matches the column title in the sheet: {}'.format(error_message, outputMap["sheetColumn"], mappingSource["sourceId"], sheetData["name"]))
-					except Exception as error_message:
-						logger.warning(error_message)
-
+				cells = self.buildCells(row, None, sheetData.name, source, mappingSource, logger, skipped)
 				payload.append({"cells": cells, "toBottom": True})
 
+			self.logSkipped(skipped, mappingSource['sourceId'], logger)
 		else:
 			logger.info('No missing rows found')
 
@@ -0,0 +1,147 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+# upper bounds in seconds of the histogram buckets, the last bucket holds everything slower
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# prefix of every metric name in the Prometheus text file
+PROMETHEUS_PREFIX = 'datatracker_'
+
+class Metrics:
+	"""
+	Counters and histograms for a run of the Data Tracker, shared by every thread.
+	Each metric has a name and labels, e.g. the sheetId and phase of a phase timer,
+	and every combination of labels is counted separately.
+
+		increment(name, value, **labels) -- adds to a counter
+		observe(name, value, **labels) -- adds a sample, usually seconds, to a histogram
+		timer(name, **labels) -- context manager that observes the seconds spent in it
+	"""
+	def __init__(self, buckets=DEFAULT_BUCKETS, clock=time.perf_counter):
+		self.buckets = tuple(buckets)
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.started = time.time()
+			self.counters = {}
+			self.histograms = {}
+
+	def increment(self, name, value=1, **labels):
+		key = (name, getLabelsKey(labels))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def observe(self, name, value, **labels):
+		key = (name, getLabelsKey(labels))
+		with self.lock:
+			if key not in self.histograms:
+				self.histograms[key] = {'count': 0, 'sum': 0, 'buckets': [0] * (len(self.buckets) + 1)}
+			histogram = self.histograms[key]
+			histogram['count'] += 1
+			histogram['sum'] += value
+			histogram['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+
+	@contextlib.contextmanager
+	def timer(self, name, **labels):
+		start = self.clock()
+		try:
+			yield
+		finally:
+			self.observe(name, self.clock() - start, **labels)
+
+	def getCounter(self, name, **labels):
+		with self.lock:
+			return self.counters.get((name, getLabelsKey(labels)), 0)
+
+	def getReport(self):
+		"""
+		Returns every metric as a dict that can be saved as JSON:
+			started -- unix time the metrics were started or last reset
+			counters -- list of {name, labels, value}
+			histograms -- list of {name, labels, count, sum, buckets} where buckets maps each
+				upper bound to the number of samples at or below it, as in Prometheus
+		"""
+		with self.lock:
+			counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+			histograms = []
+			for (name, labels), histogram in sorted(self.histograms.items()):
+				buckets = {}
+				total = 0
+				for bound, count in zip(self.buckets + ('+Inf',), histogram['buckets']):
+					total += count
+					buckets[str(bound)] = total
+				histograms.append({'name': name, 'labels': dict(labels), 'count': histogram['count'], 'sum': round(histogram['sum'], 6), 'buckets': buckets})
+
+		return {'started': self.started, 'counters': counters, 'histograms': histograms}
+
+	def getPrometheusText(self):
+		"""
+		Returns the metrics in the Prometheus text format, for the node exporter's textfile collector
+		"""
+		report = self.getReport()
+		lines = []
+		typed = set()
+
+		for counter in report['counters']:
+			name = PROMETHEUS_PREFIX + counter['name'] + '_total'
+			if name not in typed:
+				lines.append('# TYPE {} counter'.format(name))
+				typed.add(name)
+			lines.append('{}{} {}'.format(name, formatLabels(counter['labels']), counter['value']))
+
+		for histogram in report['histograms']:
+			name = PROMETHEUS_PREFIX + histogram['name']
+			if name not in typed:
+				lines.append('# TYPE {} histogram'.format(name))
+				typed.add(name)
+			for bound, count in histogram['buckets'].items():
+				lines.append('{}_bucket{} {}'.format(name, formatLabels(dict(histogram['labels'], le=bound)), count))
+			lines.append('{}_sum{} {}'.format(name, formatLabels(histogram['labels']), histogram['sum']))
+			lines.append('{}_count{} {}'.format(name, formatLabels(histogram['labels']), histogram['count']))
+
+		return '\n'.join(lines) + '\n'
+
+def getLabelsKey(labels):
+	return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def formatLabels(labels):
+	if not len(labels):
+		return ''
+	values = []
+	for key, value in labels.items():
+		value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+		values.append('{}="{}"'.format(key, value))
+	return '{' + ','.join(values) + '}'
+
+def writeFile(filePath, text):
+	"""
+	Replaces the file in one step, so a reader never sees half of it
+	"""
+	with open(filePath + '.tmp', 'w') as outputFile:
+		outputFile.write(text)
+	os.replace(filePath + '.tmp', filePath)
+
+# metrics for the whole process, like the shared HTTP client
+runMetrics = Metrics()
@@ -0,0 +1,56 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+import queue
+import threading
+import contextlib
+
+class ConnectionPool:
+	"""
+	Keeps up to size database connections open so lookups reuse them instead of
+	connecting for every query. Connections are made with connect() when none is idle.
+
+	A connection is only used by one thread at a time. When an error is raised while a
+	connection is checked out it is closed instead of being put back, so a dropped
+	connection or a half read result is never handed to the next lookup.
+	"""
+	def __init__(self, connect, size=1):
+		self.connect = connect
+		self.size = max(1, size)
+		self.idle = queue.LifoQueue()
+		self.available = threading.BoundedSemaphore(self.size)
+
+	@contextlib.contextmanager
+	def connection(self):
+		"""
+		Checks out a connection for the with block, waiting while size connections are in use
+		"""
+		with self.available:
+			try:
+				con = self.idle.get_nowait()
+			except queue.Empty:
+				con = self.connect()
+
+			try:
+				yield con
+			except BaseException:
+				try:
+					con.close()
+				except Exception:
+					pass
+				raise
+
+			self.idle.put(con)
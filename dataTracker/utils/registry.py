@@ -0,0 +1,122 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+import json
+import threading
+from utils.metrics import runMetrics
+
+class SourceRegistry:
+	"""
+	Creates the source objects from sources.json the first time a mapping uses them
+	and shares them between mappings.
+
+	Every mapping that uses a source is counted when the registry is created. After a
+	mapping releases a source and no other mapping needs it, the source object is dropped
+	so its data can be freed. With keepLoaded the source objects are kept for the next
+	run instead, and sources with a refresh method are refreshed each time they're used.
+	Sources with a setOutputKeys method are given the sourceKeys the mappings read from them.
+	"""
+	def __init__(self, sourceConfigs, mappings, logger, keepLoaded=False, previous=None):
+		self.logger = logger
+		self.keepLoaded = keepLoaded
+		self.sources = {}
+		self.users = {}
+		# the sourceKeys of every outputMapping that reads each source
+		self.outputKeys = {}
+		self.locks = {}
+		self.lock = threading.Lock()
+
+		previousObjects = {}
+		if previous is not None:
+			for sourceConf in previous.sources.values():
+				if 'sourceObject' in sourceConf:
+					previousObjects[getSourceSignature(sourceConf)] = sourceConf['sourceObject']
+
+		for sourceConf in sourceConfigs:
+			# keep the source object from the last load if its config hasn't changed
+			if getSourceSignature(sourceConf) in previousObjects:
+				sourceConf['sourceObject'] = previousObjects[getSourceSignature(sourceConf)]
+				sourceConf.setdefault('isStrict', False)
+			self.sources[sourceConf['sourceId']] = sourceConf
+			self.users[sourceConf['sourceId']] = 0
+			self.outputKeys[sourceConf['sourceId']] = set()
+			self.locks[sourceConf['sourceId']] = threading.Lock()
+
+		for mapping in mappings:
+			for sourceId in set(mappingSource['sourceId'] for mappingSource in mapping['sources']):
+				if sourceId in self.users:
+					self.users[sourceId] += 1
+			for mappingSource in mapping['sources']:
+				if mappingSource['sourceId'] in self.outputKeys:
+					self.outputKeys[mappingSource['sourceId']].update(outMap['sourceKey'] for outMap in mappingSource['outputMappings'])
+
+		for sourceId, users in self.users.items():
+			if users == 0 and 'sourceObject' in self.sources[sourceId]:
+				del self.sources[sourceId]['sourceObject']
+
+	def acquire(self, sourceId):
+		"""
+		Returns the source config with its sourceObject, creating the object if it isn't loaded yet.
+		Raises KeyError if there is no source with the id, and RuntimeError if the connector
+		ends the process while it loads, so only the mappings using the source fail.
+		"""
+		if sourceId not in self.sources:
+			raise KeyError('Source {} is not configured in sources.json'.format(sourceId))
+
+		sourceConf = self.sources[sourceId]
+		# a lock for each source so loading one source doesn't hold up mappings using another
+		with self.locks[sourceId]:
+			# connectors call theConfig.endBadly() when they can't load, which would end every other mapping too
+			try:
+				if 'sourceObject' not in sourceConf:
+					self.logger.info('Loading source {}'.format(sourceId))
+					module = __import__('connectors.' + sourceConf['connectorClassName'], fromlist=[sourceConf['connectorClassName']])
+					sourceClass = getattr(module, sourceConf['connectorClassName'])
+					with runMetrics.timer('source_load_seconds', sourceId=sourceId, connector=sourceConf['connectorClassName']):
+						sourceConf['sourceObject'] = sourceClass(sourceConf)
+				elif self.keepLoaded and hasattr(sourceConf['sourceObject'], 'refresh'):
+					# long running connectors reload their data when it changes
+					with runMetrics.timer('source_refresh_seconds', sourceId=sourceId, connector=sourceConf['connectorClassName']):
+						sourceConf['sourceObject'].refresh()
+			except SystemExit:
+				raise RuntimeError('Source {} could not be loaded, check the log for details'.format(sourceId)) from None
+
+			# connectors that can fetch less than a whole record are told which values the mappings read
+			if hasattr(sourceConf['sourceObject'], 'setOutputKeys'):
+				sourceConf['sourceObject'].setOutputKeys(self.outputKeys[sourceId])
+
+		return sourceConf
+
+	def release(self, sourceId):
+		"""
+		Called by a mapping once it is done with a source
+		"""
+		if sourceId not in self.sources or self.keepLoaded:
+			return
+
+		with self.lock:
+			self.users[sourceId] -= 1
+			if self.users[sourceId] > 0:
+				return
+
+		with self.locks[sourceId]:
+			if 'sourceObject' in self.sources[sourceId]:
+				self.logger.info('Releasing source {}'.format(sourceId))
+				del self.sources[sourceId]['sourceObject']
+
+def getSourceSignature(sourceConf):
+	# validateSourceConfig adds isStrict when it is missing, so leave it out of the comparison
+	return json.dumps({key: value for key, value in sourceConf.items() if key not in ('sourceObject', 'isStrict')}, sort_keys=True, default=str)
@@ -0,0 +1,87 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class Scheduler:
+	"""
+	Runs each mapping on its own interval with a pool of workers.
+
+	runMapping(mapping) is called for every run of a mapping.
+
+	A mapping is never run again while its previous run is still going, that cycle is skipped.
+	Two mappings for the same sheet never run at the same time, the later one waits for the next tick.
+	"""
+	def __init__(self, mappings, runMapping, defaultInterval, workers, logger, clock=time.monotonic, sleep=time.sleep):
+		self.runMapping = runMapping
+		self.workers = max(1, workers)
+		self.logger = logger
+		self.clock = clock
+		self.sleep = sleep
+		self.jobs = []
+		self.sheetLocks = {}
+		self.lock = threading.Lock()
+
+		for mapping in mappings:
+			self.jobs.append({'mapping': mapping, 'interval': mapping.get('interval', defaultInterval), 'nextRun': 0, 'running': False})
+			self.sheetLocks.setdefault(mapping['sheetId'], threading.Lock())
+
+	def runUntil(self, deadline=None):
+		"""
+		Starts mappings as they come due until the clock passes deadline, or forever without one.
+		Returns once the runs in progress have finished.
+		"""
+		if not len(self.jobs):
+			return
+
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			while deadline is None or self.clock() < deadline:
+				now = self.clock()
+
+				for job in self.jobs:
+					if job['nextRun'] > now:
+						continue
+
+					with self.lock:
+						if job['running']:
+							self.logger.info('Skipping sheet {}, its previous run is still going'.format(job['mapping']['sheetId']))
+							job['nextRun'] = now + job['interval']
+							continue
+
+					sheetLock = self.sheetLocks[job['mapping']['sheetId']]
+					if not sheetLock.acquire(blocking=False):
+						# another mapping for this sheet is running, try again on the next tick
+						continue
+
+					with self.lock:
+						job['running'] = True
+					job['nextRun'] = now + job['interval']
+					executor.submit(self.runJob, job, sheetLock)
+
+				nextRun = min(job['nextRun'] for job in self.jobs)
+				self.sleep(min(max(1, nextRun - self.clock()), 60))
+
+	def runJob(self, job, sheetLock):
+		try:
+			self.runMapping(job['mapping'])
+		except Exception as error_message:
+			self.logger.error('Scheduled run for sheet {} failed: {}'.format(job['mapping']['sheetId'], error_message), exc_info=True)
+		finally:
+			sheetLock.release()
+			with self.lock:
+				job['running'] = False
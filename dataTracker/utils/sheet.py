@@ -0,0 +1,180 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+class SheetReader:
+	"""
+	Reads a sheet a page of rows at a time, asking Smartsheet for only the columns that are needed.
+	Each page is added to a SheetData and dropped, so memory use doesn't grow with the width of the sheet.
+	"""
+	def __init__(self, apiClient, apiURL, headers, pageSize=5000, maxAttempts=3):
+		self.apiClient = apiClient
+		self.apiURL = apiURL
+		self.headers = headers
+		self.pageSize = pageSize
+		self.maxAttempts = maxAttempts
+
+	def read(self, sheetId, columnTitles):
+		"""
+		Returns a SheetData with the sheet's rows and the cells of the columns titled in columnTitles.
+		Raises requests.exceptions.HTTPError when Smartsheet returns an error.
+		"""
+		columns = self.getColumns(sheetId)
+		columnIds = [column['id'] for column in columns if column['title'] in columnTitles]
+
+		for attempt in range(self.maxAttempts):
+			sheetData = self.readPages(sheetId, columns, columnIds)
+			if sheetData is not None:
+				return sheetData
+
+		raise RuntimeError('Sheet {} kept changing while it was being read'.format(sheetId))
+
+	def getColumns(self, sheetId):
+		response = self.apiClient.get('{}/sheets/{}/columns'.format(self.apiURL, sheetId), params={'includeAll': 'true'}, headers=self.headers)
+		response.raise_for_status()
+		return [{'id': column['id'], 'title': column['title']} for column in response.json()['data']]
+
+	def readPages(self, sheetId, columns, columnIds):
+		"""
+		Reads every page of rows. Returns None if the sheet changed between pages, as rows may have moved from one page to another.
+		"""
+		sheetData = None
+		page = 1
+
+		while True:
+			params = {'page': page, 'pageSize': self.pageSize}
+			if len(columnIds):
+				params['columnIds'] = ','.join(str(columnId) for columnId in columnIds)
+
+			response = self.apiClient.get('{}/sheets/{}'.format(self.apiURL, sheetId), params=params, headers=self.headers)
+			response.raise_for_status()
+			sheetPage = response.json()
+
+			if sheetData is None:
+				sheetData = SheetData(sheetPage['id'], sheetPage['name'], sheetPage.get('version'), columns, columnIds)
+			elif sheetPage.get('version') != sheetData.version:
+				return None
+
+			rows = sheetPage.get('rows', [])
+			sheetData.addRows(rows)
+
+			if len(rows) < self.pageSize or ('totalRowCount' in sheetPage and len(sheetData) >= sheetPage['totalRowCount']):
+				return sheetData
+			page += 1
+
+class SheetData:
+	"""
+	Column oriented copy of a sheet. Rows are addressed by their position, and every column that was read
+	keeps a list of cell values and a list of display values, holding None for blank cells.
+
+		id, name, version -- of the sheet
+		columns -- id and title of every column in the sheet, including columns that weren't read
+		rowIds, modifiedAt -- one entry for each row
+	"""
+	def __init__(self, sheetId, name, version, columns, columnIds):
+		self.id = sheetId
+		self.name = name
+		self.version = version
+		self.columns = columns
+		self.rowIds = []
+		self.modifiedAt = []
+		self.values = {}
+		self.displayValues = {}
+
+		for columnId in columnIds:
+			self.values[columnId] = []
+			self.displayValues[columnId] = []
+
+	def __len__(self):
+		return len(self.rowIds)
+
+	def addRows(self, rows):
+		for row in rows:
+			self.rowIds.append(row['id'])
+			self.modifiedAt.append(row.get('modifiedAt'))
+
+			cells = {}
+			for cell in row.get('cells', []):
+				cells[cell['columnId']] = cell
+
+			for columnId in self.values:
+				cell = cells.get(columnId, {})
+				self.values[columnId].append(cell.get('value'))
+				self.displayValues[columnId].append(cell.get('displayValue'))
+
+	def getCell(self, position, columnId):
+		"""
+		Returns the cell in the same form as the API, without the value or displayValue when they are blank.
+		Returns None if the column wasn't read.
+		"""
+		if columnId not in self.values:
+			return None
+
+		cell = {'columnId': columnId}
+		if self.values[columnId][position] is not None:
+			cell['value'] = self.values[columnId][position]
+		if self.displayValues[columnId][position] is not None:
+			cell['displayValue'] = self.displayValues[columnId][position]
+		return cell
+
+	def getColumn(self, columnId):
+		"""
+		Returns the display value of each row in the column, or the value for cells without a display value
+		"""
+		return [displayValue if displayValue is not None else value for value, displayValue in zip(self.values.get(columnId, []), self.displayValues.get(columnId, []))]
+
+	def subset(self, positions):
+		"""
+		Returns a SheetData with only the rows at positions
+		"""
+		sheetData = SheetData(self.id, self.name, self.version, self.columns, self.values.keys())
+		sheetData.rowIds = [self.rowIds[position] for position in positions]
+		sheetData.modifiedAt = [self.modifiedAt[position] for position in positions]
+
+		for columnId in self.values:
+			sheetData.values[columnId] = [self.values[columnId][position] for position in positions]
+			sheetData.displayValues[columnId] = [self.displayValues[columnId][position] for position in positions]
+
+		return sheetData
+
+class SheetIndex:
+	"""
+	Lookups into a SheetData, built once when the sheet is read so nothing has to scan the rows:
+		column title to column id
+		row id and column id to cell
+	"""
+	def __init__(self, sheetData):
+		self.sheetData = sheetData
+		self.columnIds = {}
+		self.positions = {}
+
+		for column in sheetData.columns:
+			self.columnIds.setdefault(column['title'], column['id'])
+		for position, rowId in enumerate(sheetData.rowIds):
+			self.positions[rowId] = position
+
+	def getColumnId(self, title):
+		"""
+		Returns the id of the column with the title, None if the sheet has no such column
+		"""
+		return self.columnIds.get(title)
+
+	def getCell(self, rowId, columnId):
+		"""
+		Returns the cell in the same form as the API, None if the row or the column wasn't read
+		"""
+		if rowId not in self.positions:
+			return None
+		return self.sheetData.getCell(self.positions[rowId], columnId)
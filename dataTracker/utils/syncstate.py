@@ -0,0 +1,89 @@
+# ----------------------------------------------------------------------
+#   Copyright 2014 Smartsheet, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# ----------------------------------------------------------------------
+
+import os
+import json
+import hashlib
+import threading
+
+class SyncState:
+	"""
+	Remembers what each mapping last synced, so a run can tell when nothing has changed.
+	The state is kept in a JSON file in the settings directory and survives restarts.
+
+	Each mapping gets a dict of:
+		version -- the sheet version after the last successful run
+		fingerprints -- sourceId to the source's fingerprint at the last successful run
+		rows -- rowId to the row's modifiedAt at the last successful run
+	"""
+	def __init__(self, filePath, logger):
+		self.filePath = filePath
+		self.logger = logger
+		self.states = {}
+		self.lock = threading.Lock()
+
+		try:
+			with open(self.filePath) as stateFile:
+				self.states = json.load(stateFile)
+		except FileNotFoundError:
+			pass
+		except ValueError as error_message:
+			# a damaged state file only costs one full sync
+			self.logger.warning('Ignoring sync state in {}: {}'.format(self.filePath, error_message))
+
+	def getKey(self, mapping):
+		# the column ids are added to the mapping while it runs, leave them out so the key stays the same
+		mappingConfig = json.dumps(stripColumnIds(mapping), sort_keys=True, default=str)
+		return '{}-{}'.format(mapping['sheetId'], hashlib.sha1(mappingConfig.encode('utf-8')).hexdigest()[:12])
+
+	def getState(self, mapping):
+		"""
+		Returns the state of the mapping's last successful run, an empty dict if there isn't one
+		or the mapping's config has changed since. The dict must not be changed, use setState instead.
+		"""
+		with self.lock:
+			return self.states.get(self.getKey(mapping), {})
+
+	def setState(self, mapping, state):
+		with self.lock:
+			self.states[self.getKey(mapping)] = state
+
+	def retain(self, mappings):
+		"""
+		Forgets the state of mappings that are no longer configured
+		"""
+		keys = set(self.getKey(mapping) for mapping in mappings)
+		with self.lock:
+			for key in list(self.states):
+				if key not in keys:
+					del self.states[key]
+
+	def save(self):
+		with self.lock:
+			try:
+				# write to a temporary file first so a crash can't leave half a state file behind
+				with open(self.filePath + '.tmp', 'w') as stateFile:
+					json.dump(self.states, stateFile)
+				os.replace(self.filePath + '.tmp', self.filePath)
+			except (OSError, TypeError, ValueError) as error_message:
+				self.logger.error('Unable to save sync state to {}: {}'.format(self.filePath, error_message))
+
+def stripColumnIds(config):
+	if isinstance(config, dict):
+		return {key: stripColumnIds(value) for key, value in config.items() if key != 'sheetColumnId'}
+	if isinstance(config, list):
+		return [stripColumnIds(value) for value in config]
+	return config